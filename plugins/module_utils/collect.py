@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Ansible Project
+# GNU General Public License v3.0+ (see LICENSES/GPL-3.0-or-later.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import multiprocessing
+import os
+import sys
+
+from multiprocessing.pool import ThreadPool
+
+from ansible_collections.community.internal_test_tools.plugins.module_utils.digest_cache import (
+    DigestCache,
+)
+
+from ansible_collections.community.internal_test_tools.plugins.module_utils.stats import (
+    Stats,
+)
+
+from ansible_collections.community.internal_test_tools.plugins.module_utils.state import (
+    ContentStore,
+    FileDigester,
+    PreviousState,
+    extract_stat,
+    is_regular_file,
+    is_symlink,
+    walk,
+)
+
+if sys.version_info[0] >= 3:
+    import typing as t
+
+
+class CollectError(Exception):
+    pass
+
+
+def store_content(
+    digester,  # type: FileDigester
+    path,  # type: str
+    result,  # type: dict[str, t.Any]
+    check_content,  # type: bool
+    stat,  # type: os.stat_result
+    content_store,  # type: ContentStore
+):
+    # type: (...) -> None
+    if check_content:
+        result.update(digester.content(path, stat, encode=content_store.encode))
+    else:
+        result.update(digester.digests(path, stat))
+
+
+def add_file(
+    digester,  # type: FileDigester
+    files,  # type: dict[str, dict[str, t.Any]]
+    path,  # type: str
+    check_content=True,  # type: bool
+    allow_not_existing=False,  # type: bool
+    stat_only=False,  # type: bool
+    pending=None,  # type: list[tuple[str, dict[str, t.Any], bool, os.stat_result]] | None
+    stat=None,  # type: os.stat_result | None
+    content_store=None,  # type: ContentStore | None
+    previous=None,  # type: PreviousState | None
+    content_max_size=None,  # type: int | None
+):
+    # type: (...) -> None
+    result = {}  # type: dict[str, t.Any]
+    files[path] = result
+    stats = digester.stats
+
+    # If the caller already provided the lstat() result, only symlinks need to be checked for existence
+    if stat is None or is_symlink(stat):
+        if stats is not None:
+            stats.count('stat')
+        if not os.path.exists(path):
+            if not allow_not_existing:
+                raise CollectError('The file "{path}" does not exist'.format(path=path))
+            result['exists'] = False
+            return
+
+    if stat is None:
+        if stats is not None:
+            stats.count('lstat')
+            stats.visit(files=1)
+        stat = os.lstat(path)
+    result['stat'] = extract_stat(stat)
+
+    if is_symlink(stat):
+        # Record symlink information
+        if stats is not None:
+            stats.count('readlink')
+        result['symlink'] = os.readlink(path)
+        return
+    elif is_regular_file(stat):
+        if stat_only:
+            return
+        if content_max_size is not None and stat.st_size > content_max_size:
+            check_content = False
+        content_store = content_store or ContentStore()
+        if previous is not None and previous.reuse(path, result, check_content, digester, content_store):
+            return
+        # Record file content (or defer this to store_contents() if pending is provided)
+        if pending is not None:
+            pending.append((path, result, check_content, stat))
+        else:
+            store_content(digester, path, result, check_content, stat, content_store)
+    else:
+        raise CollectError('The path "{path}" is not a file or symlink - this is not yet supported!'.format(path=path))  # pragma: no cover
+
+
+def store_contents(
+    digester,  # type: FileDigester
+    pending,  # type: list[tuple[str, dict[str, t.Any], bool, os.stat_result]]
+    workers,  # type: int
+    content_store,  # type: ContentStore
+):
+    # type: (...) -> None
+    def process(job):
+        # type: (tuple[str, dict[str, t.Any], bool, os.stat_result]) -> None
+        store_content(digester, job[0], job[1], job[2], job[3], content_store)
+
+    pool = ThreadPool(min(workers, len(pending)))
+    try:
+        # Every job writes into its own result dictionary, so no locking is needed
+        pool.map(process, pending, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def collect_directory(
+    digester,  # type: FileDigester
+    files,  # type: dict[str, dict[str, t.Any]]
+    directories,  # type: dict[str, dict[str, t.Any]]
+    directory,  # type: dict[str, t.Any]
+    pending=None,  # type: list[tuple[str, dict[str, t.Any], bool, os.stat_result]] | None
+    content_store=None,  # type: ContentStore | None
+    previous=None,  # type: PreviousState | None
+    stack=None,  # type: list[tuple[str, os.stat_result | None, int]] | None
+    should_stop=None,  # type: t.Callable[[], bool] | None
+):
+    # type: (...) -> None
+    """
+    Collect the state of the files and directories of an entry of the ``directories`` option of files_collect.
+
+    ``stack`` and ``should_stop`` are passed on to ``walk()``.
+    """
+    stats = digester.stats
+    dir_walk = walk(
+        directory['path'], include=directory['include'], exclude=directory['exclude'], max_depth=directory['max_depth'], stats=stats,
+        stack=stack, should_stop=should_stop,
+    )
+    if stats is not None:
+        dir_walk = stats.timed('walk', dir_walk)
+    for dirpath, dirstat, dirnames, dirfiles in dir_walk:
+        filenames = []
+        for file, stat in dirfiles:
+            filenames.append(file)
+            add_file(
+                digester,
+                files,
+                os.path.join(dirpath, file),
+                check_content=directory['check_content'],
+                allow_not_existing=False,
+                stat_only=directory['stat_only'],
+                content_max_size=directory['content_max_size'],
+                pending=pending,
+                stat=stat,
+                content_store=content_store,
+                previous=previous,
+            )
+        directory_entry = {}  # type: dict[str, t.Any]
+        directories[dirpath] = directory_entry
+
+        directory_entry['stat'] = extract_stat(dirstat)
+        # Store the filters so that files_diff can apply them when listing the directory
+        if directory['include']:
+            directory_entry['include'] = directory['include']
+        if directory['exclude']:
+            directory_entry['exclude'] = directory['exclude']
+
+        directory_entry['files'] = filenames
+        if not directory['recursive']:
+            break
+        directory_entry['directories'] = dirnames
+        if directory['max_depth'] is not None:
+            # Store how many levels below this directory were collected, so that files_diff can honor the depth limit
+            depth = 0 if dirpath == directory['path'] else os.path.relpath(dirpath, directory['path']).count(os.sep) + 1
+            directory_entry['max_depth'] = directory['max_depth'] - depth
+
+
+# The options of collect_directories_in_processes() in a worker process, set by _init_process()
+_process_options = {}  # type: dict[str, t.Any]
+
+
+def _init_process(options):
+    # type: (dict[str, t.Any]) -> None
+    # Runs once when a worker process is started. The options, which include the potentially large previous state, are
+    # passed here instead of with every job. With fork(), they are inherited by the worker process without pickling.
+    _process_options.clear()
+    _process_options.update(options)
+
+
+def _collect_directory_in_process(directory):
+    # type: (dict[str, t.Any]) -> dict[str, t.Any]
+    # Runs in a worker process. Since the module object is not available there, everything needed is passed in options.
+    options = _process_options
+    stats = None
+    if options['stats_slowest_files'] is not None:
+        stats = Stats(slowest_files=options['stats_slowest_files'])
+    cache = None
+    if options['digest_cache'] is not None:
+        cache = DigestCache(options['digest_cache'], options['digest_cache_size'], algorithm=options['algorithm'])
+    digester = FileDigester(
+        None,
+        cache=cache,
+        algorithm=options['algorithm'],
+        block_digest_threshold=options['block_digest_threshold'],
+        block_size=options['block_size'],
+        stats=stats,
+    )
+    content_store = ContentStore(compression=options['compression'], deduplicate=options['deduplicate'])
+    files = {}  # type: dict[str, dict[str, t.Any]]
+    directories = {}  # type: dict[str, dict[str, t.Any]]
+    pending = [] if options['workers'] > 1 else None  # type: list[tuple[str, dict[str, t.Any], bool, os.stat_result]] | None
+    try:
+        collect_directory(digester, files, directories, directory, pending=pending, content_store=content_store, previous=options['previous'])
+    except CollectError as exc:
+        return dict(error=str(exc))
+    if pending:
+        store_contents(digester, pending, options['workers'], content_store)
+    return dict(
+        files=files,
+        directories=directories,
+        contents=content_store.contents,
+        cache_updates=cache.get_updates() if cache is not None else None,
+        stats=stats,
+    )
+
+
+def collect_directories_in_processes(
+    digester,  # type: FileDigester
+    files,  # type: dict[str, dict[str, t.Any]]
+    directories,  # type: dict[str, dict[str, t.Any]]
+    entries,  # type: list[dict[str, t.Any]]
+    processes,  # type: int
+    workers,  # type: int
+    content_store,  # type: ContentStore
+    previous=None,  # type: PreviousState | None
+):
+    # type: (...) -> None
+    """
+    Collect the state of several entries of the ``directories`` option of files_collect, each in a worker process.
+
+    The results are merged into ``files``, ``directories``, ``content_store``, and the digest cache and statistics of
+    ``digester`` in the order of the entries, so that the result is the same as when collecting them one after another.
+    Raises ``CollectError`` if collecting one of the entries fails.
+    """
+    options = dict(
+        algorithm=digester.algorithm,
+        block_digest_threshold=digester.block_digest_threshold,
+        block_size=digester.block_size,
+        compression=content_store.compression,
+        deduplicate=content_store.deduplicate,
+        workers=workers,
+        digest_cache=digester.cache.path if digester.cache is not None else None,
+        digest_cache_size=digester.cache.max_size if digester.cache is not None else None,
+        stats_slowest_files=digester.stats.slowest_files if digester.stats is not None else None,
+        previous=previous,
+    )
+    try:
+        # Use fork() where possible, so that the worker processes do not need to import the module again
+        context = multiprocessing.get_context('fork')  # type: t.Any
+    except (AttributeError, ValueError):
+        # Python 2 always uses fork() on POSIX systems
+        context = multiprocessing
+    pool = context.Pool(min(processes, len(entries)), initializer=_init_process, initargs=(options,))
+    try:
+        results = pool.map(_collect_directory_in_process, entries, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for result in results:
+        if 'error' in result:
+            raise CollectError(result['error'])
+        files.update(result['files'])
+        directories.update(result['directories'])
+        content_store.contents.update(result['contents'])
+        if digester.cache is not None:
+            digester.cache.merge(result['cache_updates'])
+        if digester.stats is not None:
+            digester.stats.merge(result['stats'])
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Ansible Project
+# GNU General Public License v3.0+ (see LICENSES/GPL-3.0-or-later.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+if sys.version_info[0] >= 3:
+    import typing as t
+
+    if t.TYPE_CHECKING:  # pragma: no cover
+        from os import stat_result  # pragma: no cover
+
+
+CACHE_VERSION = 2
+
+# Files whose modification or change time is closer than this (in seconds) to the current time
+# are not cached, since further modifications within the timestamp granularity would not be noticed
+RACY_INTERVAL = 2
+
+
+def _get_ns(stat, name):
+    # type: (stat_result, str) -> int
+    value = getattr(stat, 'st_{0}_ns'.format(name), None)
+    if value is None:
+        # Python 2 does not provide nanosecond timestamps
+        value = int(getattr(stat, 'st_{0}'.format(name)) * 1000000000)
+    return value
+
+
+class DigestCache(object):
+    '''
+    Maps stat fingerprints (device, inode, size, modification and change time) of files to their digests.
+
+    Digests of different algorithms are cached separately; ``algorithm`` selects the one used by this instance.
+
+    The cache is stored as a JSON file. When saving, only the ``max_size`` most recently used entries are kept.
+    '''
+
+    def __init__(self, path, max_size, algorithm='sha256'):
+        # type: (str, int, str) -> None
+        self.path = path
+        self.max_size = max_size
+        self.algorithm = algorithm
+        self.now = time.time()
+        self._entries = {}  # type: dict[str, list[t.Any]]
+        self._updates = {}  # type: dict[str, str]
+        self._counter = itertools.count()
+        self._load()
+
+    def _load(self):
+        # type: () -> None
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            # A missing or broken cache is treated as an empty one
+            return
+        if not isinstance(data, dict) or data.get('version') != CACHE_VERSION or not isinstance(data.get('entries'), dict):
+            return
+        entries = data['entries']
+        for key, value in entries.items():
+            # Ignore broken entries. JSON strings are always decoded to text; bool is a subclass of int, but not a counter.
+            if (
+                isinstance(value, list) and len(value) == 2 and isinstance(value[0], type(u''))
+                and isinstance(value[1], int) and not isinstance(value[1], bool)
+            ):
+                self._entries[key] = value
+        if self._entries:
+            self._counter = itertools.count(max(value[1] for value in self._entries.values()) + 1)
+
+    def get_key(self, stat):
+        # type: (stat_result) -> str
+        return '{algorithm}:{dev}:{inode}:{size}:{mtime}:{ctime}'.format(
+            algorithm=self.algorithm,
+            dev=stat.st_dev,
+            inode=stat.st_ino,
+            size=stat.st_size,
+            mtime=_get_ns(stat, 'mtime'),
+            ctime=_get_ns(stat, 'ctime'),
+        )
+
+    def get(self, stat):
+        # type: (stat_result) -> str | None
+        entry = self._entries.get(self.get_key(stat))
+        if entry is None:
+            return None
+        entry[1] = next(self._counter)
+        digest = entry[0]  # type: str
+        return digest
+
+    def set(self, stat, digest):
+        # type: (stat_result, str) -> None
+        if self.now - max(stat.st_mtime, stat.st_ctime) < RACY_INTERVAL:
+            return
+        key = self.get_key(stat)
+        self._entries[key] = [digest, next(self._counter)]
+        self._updates[key] = digest
+
+    def get_updates(self):
+        # type: () -> dict[str, str]
+        # Returns the entries set since the cache was loaded, so that they can be merged into another instance
+        return dict(self._updates)
+
+    def merge(self, updates):
+        # type: (dict[str, str]) -> None
+        for key, digest in updates.items():
+            self._entries[key] = [digest, next(self._counter)]
+            self._updates[key] = digest
+
+    def save(self):
+        # type: () -> None
+        entries = sorted(self._entries.items(), key=lambda entry: entry[1][1], reverse=True)[:self.max_size]
+        data = {
+            'version': CACHE_VERSION,
+            # Renumber the entries so that the counters do not grow indefinitely
+            'entries': dict((key, [value[0], len(entries) - index]) for index, (key, value) in enumerate(entries)),
+        }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.digest-cache-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(data, sort_keys=True).encode('utf-8'))
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
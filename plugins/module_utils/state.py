@@ -7,7 +7,33 @@
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
+import base64
+import fnmatch
+import functools
+import hashlib
+import json
+import os
+import stat as _stat
 import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from ansible_collections.community.internal_test_tools.plugins.module_utils.digest_cache import (
+    RACY_INTERVAL,
+)
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    # Python 2, or Python 3 built without lzma support
+    lzma = None  # type: ignore
+
+try:
+    import xxhash  # type: ignore
+except ImportError:  # pragma: no cover
+    xxhash = None
 
 if sys.version_info[0] >= 3:
     import typing as t
@@ -17,16 +43,660 @@ if sys.version_info[0] >= 3:
 
         from ansible.module_utils.basic import AnsibleModule  # pragma: no cover
 
+        from .digest_cache import DigestCache  # pragma: no cover
+        from .stats import Stats  # pragma: no cover
+
 
 STATE_VERSION = 1
 
+# Version of the compact state format (see compact_state())
+COMPACT_STATE_VERSION = 2
+
+# The keys of the dictionaries returned by extract_stat()
+STAT_FIELDS = (
+    'mode', 'inode', 'dev', 'nlink', 'uid', 'gid', 'size', 'mtime', 'ctime', 'blocks', 'blksize', 'rdev',
+    'flags', 'gen', 'birthtime', 'ftype', 'attrs', 'obtype',
+)
+
+# Fields whose values usually repeat a lot, and which are stored in a lookup table in the compact state format
+INTERNED_STAT_FIELDS = ('mode', 'dev', 'uid', 'gid', 'blksize', 'rdev')
+
+# Size of the chunks read when computing digests of files
+CHUNK_SIZE = 1024 * 1024
+
+# The default digest algorithm for files
+DEFAULT_DIGEST_ALGORITHM = 'sha256'
+
+# Digest algorithms provided by hashlib, and by the optional xxhash library
+HASHLIB_DIGEST_ALGORITHMS = ('sha256', 'sha1', 'md5', 'blake2b')
+XXHASH_DIGEST_ALGORITHMS = ('xxh64', 'xxh3_64', 'xxh3_128')
+
+# The default size of the blocks for which block digests are computed
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+
 
 def read_file(module, path):
-    # type: (AnsibleModule, str | bytes) -> bytes
+    # type: (AnsibleModule | None, str | bytes) -> bytes
     with open(path, 'rb') as f:
         return f.read()
 
 
+def get_compressions():
+    # type: () -> list[str]
+    # Return the content compressions supported by this Python
+    result = ['zlib']
+    if lzma is not None:
+        result.append('lzma')
+    return result
+
+
+def encode_content(content, compression=None):
+    # type: (bytes, str | None) -> dict[str, t.Any]
+    # Returns the keys that represent the content in a file entry of the state
+    if compression == 'zlib':
+        content = zlib.compress(content, 9)
+    elif compression == 'lzma':
+        content = lzma.compress(content)
+    result = {'content': base64.b64encode(content)}  # type: dict[str, t.Any]
+    if compression is not None:
+        result['content_compression'] = compression
+    return result
+
+
+class ContentStore(object):
+    '''
+    Encodes file contents for the state, optionally compressing and deduplicating them.
+
+    With deduplication, every distinct content is stored once in ``contents``, keyed by its SHA-256 digest,
+    and file entries only reference that digest as ``content_digest``.
+    '''
+
+    def __init__(self, compression=None, deduplicate=False):
+        # type: (str | None, bool) -> None
+        self.compression = compression
+        self.deduplicate = deduplicate
+        self.contents = {}  # type: dict[str, dict[str, t.Any]]
+
+    def encode(self, content):
+        # type: (bytes) -> dict[str, t.Any]
+        # Returns the keys that represent the content in a file entry of the state
+        if not self.deduplicate:
+            return encode_content(content, compression=self.compression)
+        digest = hashlib.sha256(content).hexdigest()
+        if digest not in self.contents:
+            self.contents[digest] = encode_content(content, compression=self.compression)
+        return {'content_digest': digest}
+
+
+def has_content(entry):
+    # type: (dict[str, t.Any]) -> bool
+    return 'content' in entry or 'content_digest' in entry
+
+
+def decode_content(entry, contents=None):
+    # type: (dict[str, t.Any], dict[str, dict[str, t.Any]] | None) -> bytes
+    # Returns the content of a file entry of the state; contents is the state's table of deduplicated contents
+    if 'content_digest' in entry:
+        if not contents or entry['content_digest'] not in contents:
+            raise ValueError('Cannot find content with digest {0}'.format(entry['content_digest']))
+        entry = contents[entry['content_digest']]
+    content = base64.b64decode(entry['content'])
+    compression = entry.get('content_compression')
+    if compression == 'zlib':
+        content = zlib.decompress(content)
+    elif compression == 'lzma':
+        if lzma is None:
+            raise ValueError('lzma compressed content is not supported by this Python')
+        content = lzma.decompress(content)
+    elif compression is not None:
+        raise ValueError('Unknown content compression {0!r}'.format(compression))
+    return content
+
+
+def create_digest(algorithm=DEFAULT_DIGEST_ALGORITHM):
+    # type: (str) -> t.Any
+    # Create a hash object for the given algorithm. Raises ValueError if the algorithm is not available.
+    if algorithm in HASHLIB_DIGEST_ALGORITHMS and hasattr(hashlib, algorithm):
+        # Can raise ValueError, for example for md5 in FIPS mode
+        return getattr(hashlib, algorithm)()
+    if algorithm in XXHASH_DIGEST_ALGORITHMS and xxhash is not None and hasattr(xxhash, algorithm):
+        return getattr(xxhash, algorithm)()
+    raise ValueError('Unsupported digest algorithm {0!r}'.format(algorithm))
+
+
+def hash_file(module, path, algorithm=DEFAULT_DIGEST_ALGORITHM):
+    # type: (AnsibleModule | None, str | bytes, str) -> str
+    # Read the file in fixed-size chunks so that memory usage does not depend on the file's size
+    digest = create_digest(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    result = digest.hexdigest()  # type: str
+    return result
+
+
+def iter_block_digests(f, block_size, algorithm=DEFAULT_DIGEST_ALGORITHM, digest=None):
+    # type: (t.BinaryIO, int, str, t.Any) -> t.Iterator[str]
+    # Yield the digests of the consecutive blocks of block_size bytes read from f (the last block can be shorter).
+    # Everything read is also fed into digest if provided.
+    while True:
+        block_digest = create_digest(algorithm)
+        remaining = block_size
+        while remaining > 0:
+            chunk = f.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                break
+            block_digest.update(chunk)
+            if digest is not None:
+                digest.update(chunk)
+            remaining -= len(chunk)
+        if remaining == block_size:
+            return
+        yield block_digest.hexdigest()
+        if remaining > 0:
+            return
+
+
+def hash_file_blocks(module, path, block_size, algorithm=DEFAULT_DIGEST_ALGORITHM):
+    # type: (AnsibleModule | None, str | bytes, int, str) -> tuple[str, list[str]]
+    # Compute the digest of the whole file and the digests of its blocks in one pass
+    digest = create_digest(algorithm)
+    with open(path, 'rb') as f:
+        blocks = list(iter_block_digests(f, block_size, algorithm=algorithm, digest=digest))
+    return digest.hexdigest(), blocks
+
+
+class _MemoEntry(object):
+    def __init__(self):
+        # type: () -> None
+        self.done = threading.Event()
+        self.value = None  # type: t.Any
+        self.error = None  # type: BaseException | None
+
+
+class FileDigester(object):
+    '''
+    Computes digests and reads contents of files, optionally consulting a digest cache before reading a file.
+
+    The digests are computed with ``algorithm``; the digest cache must use the same algorithm. For files larger than
+    ``block_digest_threshold`` bytes, ``digests()`` also computes the digests of their blocks of ``block_size`` bytes.
+    If ``stats`` is provided, the files read and the time spent are recorded there.
+
+    Files with multiple hardlinks are read at most once: the result for an inode is shared by all its links.
+    This is thread-safe; if another thread is already processing an inode, the result of that thread is awaited.
+    '''
+
+    def __init__(
+        self,
+        module,  # type: AnsibleModule | None
+        cache=None,  # type: DigestCache | None
+        algorithm=DEFAULT_DIGEST_ALGORITHM,  # type: str
+        block_digest_threshold=None,  # type: int | None
+        block_size=DEFAULT_BLOCK_SIZE,  # type: int
+        stats=None,  # type: Stats | None
+    ):
+        # type: (...) -> None
+        self.module = module
+        self.cache = cache
+        self.stats = stats
+        self.algorithm = algorithm
+        self.block_digest_threshold = block_digest_threshold
+        self.block_size = block_size
+        self._memo = {}  # type: dict[tuple[t.Any, ...], _MemoEntry]
+        self._memo_lock = threading.Lock()
+
+    def _memoize(self, kind, stat, compute):
+        # type: (str, stat_result, t.Callable[[], t.Any]) -> t.Any
+        if stat.st_nlink <= 1:
+            return compute()
+        key = (kind, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime, stat.st_ctime)
+        with self._memo_lock:
+            entry = self._memo.get(key)
+            owner = entry is None
+            if entry is None:
+                entry = self._memo[key] = _MemoEntry()
+        if owner:
+            try:
+                entry.value = compute()
+            except BaseException as exc:
+                entry.error = exc
+                raise
+            finally:
+                entry.done.set()
+        else:
+            entry.done.wait()
+            if entry.error is not None:
+                raise entry.error
+        return entry.value
+
+    def _record(self, path, size, start, encode_start=None):
+        # type: (str, int, float, float | None) -> None
+        # Record in the statistics that a file was read (and encoded) starting at the given times
+        if self.stats is None:
+            return
+        now = time.time()
+        self.stats.count('open')
+        self.stats.read_file(path, size, now - start)
+        self.stats.add_time('hash', (encode_start or now) - start)
+        if encode_start is not None:
+            self.stats.add_time('encode', now - encode_start)
+
+    def _digest(self, path, stat):
+        # type: (str, stat_result) -> str
+        if self.cache is not None:
+            digest = self.cache.get(stat)
+            if digest is not None:
+                return digest
+        start = time.time()
+        digest = hash_file(self.module, path, algorithm=self.algorithm)
+        self._record(path, stat.st_size, start)
+        if self.cache is not None:
+            self.cache.set(stat, digest)
+        return digest
+
+    def _block_digests(self, path, stat):
+        # type: (str, stat_result) -> dict[str, t.Any]
+        start = time.time()
+        digest, blocks = hash_file_blocks(self.module, path, self.block_size, algorithm=self.algorithm)
+        self._record(path, stat.st_size, start)
+        if self.cache is not None:
+            self.cache.set(stat, digest)
+        return {self.algorithm: digest, 'block_size': self.block_size, 'block_digests': blocks}
+
+    def cached_digest(self, stat):
+        # type: (stat_result) -> str | None
+        # Returns the digest of the file from the digest cache without reading the file
+        return self.cache.get(stat) if self.cache is not None else None
+
+    def digest(self, path, stat):
+        # type: (str, stat_result) -> str
+        result = self._memoize('digest', stat, lambda: self._digest(path, stat))  # type: str
+        return result
+
+    def digests(self, path, stat):
+        # type: (str, stat_result) -> dict[str, t.Any]
+        # Returns the entries to record for the file: its digest, and its block digests if it is large enough
+        if self.block_digest_threshold is not None and stat.st_size > self.block_digest_threshold:
+            result = self._memoize('blocks', stat, lambda: self._block_digests(path, stat))  # type: dict[str, t.Any]
+            return result
+        return {self.algorithm: self.digest(path, stat)}
+
+    def content(self, path, stat, encode=None):
+        # type: (str, stat_result, t.Callable[[bytes], t.Any] | None) -> t.Any
+        # Returns the content of the file, passed through encode() if provided
+        def compute():
+            # type: () -> t.Any
+            start = time.time()
+            content = read_file(self.module, path)
+            if encode is None:
+                self._record(path, len(content), start)
+                return content
+            encode_start = time.time()
+            result = encode(content)
+            self._record(path, len(content), start, encode_start=encode_start)
+            return result
+
+        return self._memoize('content' if encode is None else 'encoded', stat, compute)
+
+
+def matches_filters(name, is_dir, include=None, exclude=None):
+    # type: (str, bool, list[str] | None, list[str] | None) -> bool
+    # Excluded files and directories are skipped; include patterns only apply to files
+    if exclude and any(fnmatch.fnmatchcase(name, pattern) for pattern in exclude):
+        return False
+    if include and not is_dir and not any(fnmatch.fnmatchcase(name, pattern) for pattern in include):
+        return False
+    return True
+
+
+def _scandir(path, include=None, exclude=None):
+    # type: (str, list[str] | None, list[str] | None) -> list[tuple[str, bool, bool, t.Callable[[], stat_result]]]
+    # For every entry, returns (name, is_dir, is_symlink, get_lstat). is_dir follows symlinks (like os.walk()).
+    # If possible, get_lstat() uses the information from the directory listing and needs at most one system call.
+    # Entries not matching the filters are skipped before any further system call is made for them.
+    result = []  # type: list[tuple[str, bool, bool, t.Callable[[], stat_result]]]
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            try:
+                is_symlink = entry.is_symlink()
+            except OSError:
+                is_symlink = False
+            if not matches_filters(entry.name, is_dir, include=include, exclude=exclude):
+                continue
+            result.append((entry.name, is_dir, is_symlink, functools.partial(entry.stat, follow_symlinks=False)))
+    else:
+        # Python 2 does not have os.scandir()
+        for name in os.listdir(path):
+            entry_path = os.path.join(path, name)
+            is_dir = os.path.isdir(entry_path)
+            if not matches_filters(name, is_dir, include=include, exclude=exclude):
+                continue
+            result.append((
+                name,
+                is_dir,
+                os.path.islink(entry_path),
+                functools.partial(os.lstat, entry_path),
+            ))
+    return result
+
+
+def list_directory(path, include=None, exclude=None):
+    # type: (str, list[str] | None, list[str] | None) -> tuple[list[str], list[str]]
+    """
+    List the subdirectories and files of a directory, like one step of ``os.walk()``.
+
+    Entries not matching the filters (see ``matches_filters()``) are skipped.
+    """
+    dirnames = []  # type: list[str]
+    filenames = []  # type: list[str]
+    for name, is_dir, dummy, dummy2 in _scandir(path, include=include, exclude=exclude):
+        if is_dir:
+            dirnames.append(name)
+        else:
+            filenames.append(name)
+    return dirnames, filenames
+
+
+def scan_directory(path, include=None, exclude=None):
+    # type: (str, list[str] | None, list[str] | None) -> tuple[list[str], list[tuple[str, stat_result]], dict[str, t.Callable[[], stat_result]]]
+    """
+    List a directory like one step of ``os.walk()``, and retrieve the ``os.lstat()`` results of its files.
+
+    Returns a tuple ``(dirnames, files, subdirs)``, where ``files`` is a list of ``(filename, lstat)`` tuples,
+    and ``subdirs`` maps the names of all subdirectories that are not symlinks to functions returning their
+    ``os.lstat()`` results. Entries not matching the filters (see ``matches_filters()``) are skipped.
+    """
+    dirnames = []  # type: list[str]
+    files = []  # type: list[tuple[str, stat_result]]
+    subdirs = {}  # type: dict[str, t.Callable[[], stat_result]]
+    for name, is_dir, is_symlink, get_lstat in _scandir(path, include=include, exclude=exclude):
+        if is_dir:
+            dirnames.append(name)
+            if not is_symlink:
+                subdirs[name] = get_lstat
+        else:
+            try:
+                files.append((name, get_lstat()))
+            except OSError:
+                # The entry vanished in the meantime
+                pass
+    return dirnames, files, subdirs
+
+
+def walk(
+    top,  # type: str
+    include=None,  # type: list[str] | None
+    exclude=None,  # type: list[str] | None
+    max_depth=None,  # type: int | None
+    stats=None,  # type: Stats | None
+    stack=None,  # type: list[tuple[str, stat_result | None, int]] | None
+    should_stop=None,  # type: t.Callable[[], bool] | None
+):
+    # type: (...) -> t.Iterator[tuple[str, stat_result, list[str], list[tuple[str, stat_result]]]]
+    """
+    Walk a directory tree top-down in the same order as ``os.walk()``, without following symlinks.
+
+    For every directory, yields ``(dirpath, dirstat, dirnames, files)``, where ``dirstat`` is the ``os.lstat()``
+    result of the directory and ``files`` is a list of ``(filename, lstat)`` tuples. As for ``os.walk()``,
+    ``dirnames`` can be modified in-place to prune the walk. Every entry costs at most one ``stat`` system call.
+
+    Files and directories not matching the filters (see ``matches_filters()``) are skipped; excluded directories
+    are not descended into.
+
+    If ``max_depth`` is provided, only directories up to that many levels below ``top`` are visited.
+
+    If ``stats`` is provided, the visited entries and the system calls are recorded there.
+
+    The walk can be interrupted and continued later: ``stack`` is the list of ``(dirpath, dirstat, depth)`` tuples of the
+    directories still to be visited, where ``dirstat`` can be ``None``. If it is provided and not empty, the walk continues
+    with these directories instead of starting at ``top``. Before visiting every directory, ``should_stop()`` is called;
+    if it returns ``True``, the walk ends and ``stack`` contains the directories not visited yet.
+    """
+    if stack is None:
+        stack = []
+    if not stack:
+        if stats is not None:
+            stats.count('lstat')
+        try:
+            stack.append((top, os.lstat(top), 0))
+        except OSError:
+            return
+    while stack:
+        if should_stop is not None and should_stop():
+            return
+        dirpath, dirstat, depth = stack.pop()
+        try:
+            if dirstat is None:
+                if stats is not None:
+                    stats.count('lstat')
+                dirstat = os.lstat(dirpath)
+            dirnames, files, subdirs = scan_directory(dirpath, include=include, exclude=exclude)
+        except OSError:
+            continue
+        if stats is not None:
+            stats.count('scandir')
+            stats.count('lstat', len(files))
+            stats.visit(files=len(files), directories=1)
+        yield dirpath, dirstat, dirnames, files
+        if max_depth is not None and depth >= max_depth:
+            continue
+        for name in reversed(dirnames):
+            if name in subdirs:
+                if stats is not None:
+                    stats.count('lstat')
+                try:
+                    stack.append((os.path.join(dirpath, name), subdirs[name](), depth + 1))
+                except OSError:
+                    pass
+
+
+def iter_directories_bottom_up(directories):
+    # type: (dict[str, dict[str, t.Any]]) -> t.Iterator[str]
+    # Yields all paths of the directories dictionary of a state, every directory after all of its subdirectories
+    done = set()  # type: set[str]
+    for root in directories:
+        stack = [(root, False)]
+        while stack:
+            path, expanded = stack.pop()
+            if path in done:
+                continue
+            if expanded:
+                done.add(path)
+                yield path
+                continue
+            stack.append((path, True))
+            for name in directories[path].get('directories') or []:
+                subdir = os.path.join(path, name)
+                if subdir in directories and subdir not in done:
+                    stack.append((subdir, False))
+
+
+def _json_default(value):
+    # type: (t.Any) -> t.Any
+    # files_collect stores base64 encoded content as bytes, while files_diff receives it as text
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    raise TypeError('Cannot serialize {0!r}'.format(value))
+
+
+def tree_digest(stat, files, directories):
+    # type: (dict[str, t.Any], list[tuple[str, dict[str, t.Any]]], list[tuple[str, str | None]] | None) -> str
+    """
+    Compute the aggregate digest of a directory.
+
+    ``stat`` is the directory's ``extract_stat()`` result, ``files`` is a list of ``(filename, file_entry)`` tuples
+    (with the file entries as stored in the state), and ``directories`` is a list of ``(dirname, tree_digest)``
+    tuples, or ``None`` if the subdirectories are not recorded. The tree digest of a subdirectory is ``None``
+    if the subdirectory was not collected.
+    """
+    digest = hashlib.sha256()
+
+    def add(value):
+        # type: (t.Any) -> None
+        digest.update(json.dumps(value, sort_keys=True, default=_json_default).encode('utf-8'))
+        digest.update(b'\n')
+
+    add(['stat', stat])
+    for name, entry in sorted(files, key=lambda file: file[0]):
+        add(['file', name, entry])
+    if directories is not None:
+        add(['directories'])
+        for name, subdir_digest in sorted(directories, key=lambda directory: directory[0]):
+            add(['directory', name, subdir_digest])
+    return digest.hexdigest()
+
+
+def add_tree_digests(files, directories):
+    # type: (dict[str, dict[str, t.Any]], dict[str, dict[str, t.Any]]) -> None
+    for path in iter_directories_bottom_up(directories):
+        entry = directories[path]
+        subdirs = None  # type: list[tuple[str, str | None]] | None
+        if 'directories' in entry:
+            subdirs = [
+                (name, directories.get(os.path.join(path, name), {}).get('tree_digest'))
+                for name in entry['directories']
+            ]
+        entry['tree_digest'] = tree_digest(
+            entry['stat'],
+            [(name, files[os.path.join(path, name)]) for name in entry['files']],
+            subdirs,
+        )
+
+
+def is_state(state):
+    # type: (dict[str, t.Any]) -> bool
+    return 'files' in state and 'directories' in state and state.get('version') in (STATE_VERSION, COMPACT_STATE_VERSION)
+
+
+def is_state_handle(value):
+    # type: (dict[str, t.Any]) -> bool
+    return 'state_path' in value and 'state_digest' in value
+
+
+def write_state_file(path, state):
+    # type: (str, dict[str, t.Any]) -> str
+    # Atomically write the state to a file, and return the SHA-256 digest of the file's content
+    data = json.dumps(state, sort_keys=True, separators=(',', ':'), default=_json_default).encode('utf-8')
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.files-state-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_state_file(path, digest):
+    # type: (str, str) -> dict[str, t.Any]
+    # Read a state written by write_state_file(). Raises ValueError if the file was modified or is invalid.
+    with open(path, 'rb') as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError('The checksum of the file does not match')
+    state = json.loads(data.decode('utf-8'))
+    if not isinstance(state, dict):
+        raise ValueError('The file does not contain a state')
+    return state
+
+
+def load_state(module, value, option):
+    # type: (AnsibleModule, dict[str, t.Any], str) -> dict[str, t.Any]
+    # Return the state passed to the given option in the regular state format. Besides states, also accepts the whole
+    # result of files_collect, and handles of state files written by files_collect.
+    if not is_state(value) and not is_state_handle(value) and isinstance(value.get('state'), dict):
+        # The whole result of files_collect was passed in
+        value = value['state']
+    if is_state_handle(value):
+        try:
+            value = read_state_file(value['state_path'], value['state_digest'])
+        except (IOError, OSError, ValueError) as exc:
+            module.fail_json(msg='Cannot read the state file {path} passed to the {option} parameter: {exc}'.format(
+                path=value['state_path'], option=option, exc=exc))
+    if not is_state(value):
+        module.fail_json(msg='The value of the {option} parameter must be the result of community.internal_test_tools.files_collect'.format(option=option))
+    if value['version'] == COMPACT_STATE_VERSION:
+        value = expand_state(value)
+    return value
+
+
+class PreviousState(object):
+    '''
+    Provides the checksums and contents recorded in a previous state for files whose attributes did not change.
+
+    Only files whose modification and change times lie at least ``RACY_INTERVAL`` seconds before the time the previous
+    state was collected are considered, since further modifications within the resolution of the timestamps would not
+    have changed their attributes.
+    '''
+
+    FINGERPRINT_FIELDS = ('dev', 'inode', 'size', 'mtime', 'ctime')
+
+    def __init__(self, state):
+        # type: (dict[str, t.Any]) -> None
+        self.files = state['files']  # type: dict[str, dict[str, t.Any]]
+        self.contents = state.get('contents')  # type: dict[str, dict[str, t.Any]] | None
+        self.timestamp = state.get('timestamp')  # type: float | None
+
+    def _get_entry(self, path, stat):
+        # type: (str, dict[str, t.Any]) -> dict[str, t.Any] | None
+        entry = self.files.get(path)
+        if self.timestamp is None or entry is None or 'stat' not in entry:
+            return None
+        if any(entry['stat'].get(field) != stat[field] for field in self.FINGERPRINT_FIELDS):
+            return None
+        if self.timestamp - max(stat['mtime'], stat['ctime']) < RACY_INTERVAL:
+            return None
+        return entry
+
+    def reuse(self, path, result, check_content, digester, content_store):
+        # type: (str, dict[str, t.Any], bool, FileDigester, ContentStore) -> bool
+        # Copies the content or checksum of the file into result if the previous state has them in the requested form.
+        # Returns whether this was possible.
+        entry = self._get_entry(path, result['stat'])
+        if entry is None:
+            return False
+        if check_content:
+            if not has_content(entry):
+                return False
+            try:
+                content = decode_content(entry, contents=self.contents)
+            except ValueError:
+                return False
+            result.update(content_store.encode(content))
+            return True
+        if digester.algorithm not in entry:
+            return False
+        threshold = digester.block_digest_threshold
+        if threshold is not None and result['stat']['size'] > threshold:
+            if entry.get('block_size') != digester.block_size or 'block_digests' not in entry:
+                return False
+            result['block_size'] = entry['block_size']
+            result['block_digests'] = entry['block_digests']
+        elif 'block_digests' in entry:
+            return False
+        result[digester.algorithm] = entry[digester.algorithm]
+        return True
+
+
+def is_symlink(stat):
+    # type: (stat_result) -> bool
+    return _stat.S_ISLNK(stat.st_mode)
+
+
+def is_regular_file(stat):
+    # type: (stat_result) -> bool
+    return _stat.S_ISREG(stat.st_mode)
+
+
 def extract_stat(stat):
     # type: (stat_result) -> dict[str, t.Any]
     result = {
@@ -51,3 +721,78 @@ def extract_stat(stat):
         'obtype': getattr(stat, 'st_obtype', None),
     }
     return result
+
+
+def compact_state(state):
+    # type: (dict[str, t.Any]) -> dict[str, t.Any]
+    """
+    Convert a state into the compact state format.
+
+    Instead of a dictionary, every ``stat`` entry is a list of values (a row) for the fields listed in ``stat_fields``.
+    Fields that are ``None`` for all entries are omitted. For the fields in ``INTERNED_STAT_FIELDS``, the rows contain
+    indices into the value tables in ``stat_values``.
+    """
+    entries = [entry for key in ('files', 'directories') for entry in state[key].values() if 'stat' in entry]
+    fields = [field for field in STAT_FIELDS if any(entry['stat'].get(field) is not None for entry in entries)]
+    values = dict((field, []) for field in fields if field in INTERNED_STAT_FIELDS)  # type: dict[str, list[t.Any]]
+    indices = dict((field, {}) for field in values)  # type: dict[str, dict[t.Any, int]]
+
+    def compact_stat(stat):
+        # type: (dict[str, t.Any]) -> list[t.Any]
+        row = []
+        for field in fields:
+            value = stat.get(field)
+            if field in indices and value is not None:
+                index = indices[field].get(value)
+                if index is None:
+                    index = indices[field][value] = len(values[field])
+                    values[field].append(value)
+                value = index
+            row.append(value)
+        return row
+
+    result = dict(state)
+    result['version'] = COMPACT_STATE_VERSION
+    for key in ('files', 'directories'):
+        compacted = {}
+        for path, entry in state[key].items():
+            entry = dict(entry)
+            if 'stat' in entry:
+                entry['stat'] = compact_stat(entry['stat'])
+            compacted[path] = entry
+        result[key] = compacted
+    result['stat_fields'] = fields
+    result['stat_values'] = values
+    return result
+
+
+def expand_state(state):
+    # type: (dict[str, t.Any]) -> dict[str, t.Any]
+    """
+    Convert a state in the compact state format (see ``compact_state()``) back into the regular state format.
+    """
+    fields = state['stat_fields']
+    values = state['stat_values']
+
+    def expand_stat(row):
+        # type: (list[t.Any]) -> dict[str, t.Any]
+        stat = dict((field, None) for field in STAT_FIELDS)  # type: dict[str, t.Any]
+        for field, value in zip(fields, row):
+            if field in values and value is not None:
+                value = values[field][value]
+            stat[field] = value
+        return stat
+
+    result = dict(state)
+    result['version'] = STATE_VERSION
+    for key in ('files', 'directories'):
+        expanded = {}
+        for path, entry in state[key].items():
+            entry = dict(entry)
+            if 'stat' in entry:
+                entry['stat'] = expand_stat(entry['stat'])
+            expanded[path] = entry
+        result[key] = expanded
+    del result['stat_fields']
+    del result['stat_values']
+    return result
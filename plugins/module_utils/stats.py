@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) Ansible Project
+# GNU General Public License v3.0+ (see LICENSES/GPL-3.0-or-later.txt or https://www.gnu.org/licenses/gpl-3.0.txt)
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import heapq
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+if sys.version_info[0] >= 3:
+    import typing as t
+
+
+# The phases whose time is reported
+PHASES = ('walk', 'hash', 'encode', 'diff')
+
+
+class Stats(object):
+    '''
+    Collects statistics on the work done by files_collect and files_diff: the number of visited files and directories,
+    the number of file system calls by kind, the number of bytes read from files, the time spent per phase, and the
+    files which took longest to read.
+
+    All methods are thread-safe. The times of work done concurrently by several threads are added up.
+    Instances can be pickled to pass them between processes, and combined with ``merge()``.
+    '''
+
+    def __init__(self, slowest_files=10):
+        # type: (int) -> None
+        self.start = time.time()
+        self.slowest_files = slowest_files
+        self.files = 0
+        self.directories = 0
+        self.bytes_read = 0
+        self.syscalls = {}  # type: dict[str, int]
+        self.times = dict((phase, 0.0) for phase in PHASES)  # type: dict[str, float]
+        self._slowest = []  # type: list[tuple[float, str, int]]
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # type: () -> dict[str, t.Any]
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        # type: (dict[str, t.Any]) -> None
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def merge(self, other):
+        # type: (Stats) -> None
+        # Add the statistics of other, which were collected concurrently, to this instance
+        with self._lock:
+            self.files += other.files
+            self.directories += other.directories
+            self.bytes_read += other.bytes_read
+            for syscall, number in other.syscalls.items():
+                self.syscalls[syscall] = self.syscalls.get(syscall, 0) + number
+            for phase, seconds in other.times.items():
+                self.times[phase] += seconds
+            self._slowest = heapq.nlargest(self.slowest_files, self._slowest + other._slowest)
+            heapq.heapify(self._slowest)
+
+    def count(self, syscall, number=1):
+        # type: (str, int) -> None
+        with self._lock:
+            self.syscalls[syscall] = self.syscalls.get(syscall, 0) + number
+
+    def visit(self, files=0, directories=0):
+        # type: (int, int) -> None
+        with self._lock:
+            self.files += files
+            self.directories += directories
+
+    def add_time(self, phase, seconds):
+        # type: (str, float) -> None
+        with self._lock:
+            self.times[phase] += seconds
+
+    @contextmanager
+    def timer(self, phase):
+        # type: (str) -> t.Iterator[None]
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.time() - start)
+
+    def timed(self, phase, iterable):
+        # type: (str, t.Iterable[t.Any]) -> t.Iterator[t.Any]
+        # Yields the elements of iterable, adding the time spent retrieving them to the phase
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(phase, time.time() - start)
+            yield value
+
+    def read_file(self, path, size, seconds):
+        # type: (str, int, float) -> None
+        # Records that a file of the given size was read and hashed or encoded, which took the given time in total
+        with self._lock:
+            self.bytes_read += size
+            if len(self._slowest) < self.slowest_files:
+                heapq.heappush(self._slowest, (seconds, path, size))
+            elif self._slowest and seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, (seconds, path, size))
+
+    def get_result(self):
+        # type: () -> dict[str, t.Any]
+        times = dict(self.times)
+        times['total'] = time.time() - self.start
+        return dict(
+            files=self.files,
+            directories=self.directories,
+            syscalls=dict(self.syscalls),
+            bytes_read=self.bytes_read,
+            times=times,
+            slowest_files=[
+                dict(path=path, size=size, time=seconds)
+                for seconds, path, size in sorted(self._slowest, reverse=True)
+            ],
+        )
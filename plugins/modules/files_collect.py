@@ -21,16 +21,20 @@ description:
     exactly changed.
 extends_documentation_fragment:
   - community.internal_test_tools.attributes
-  - community.internal_test_tools.attributes.idempotent_not_modify_state
 attributes:
   check_mode:
     support: full
     details:
-      - This action does not modify state.
+      - This action does not modify state, except that the files specified in O(state_file) and O(digest_cache) are written.
+        This also happens in check mode.
   diff_mode:
     support: none
     details:
       - This action does not modify state.
+  idempotent:
+    support: full
+    details:
+      - This action does not modify state, except that the files specified in O(state_file) and O(digest_cache) are written.
 options:
   files:
     description:
@@ -46,8 +50,24 @@ options:
         description:
           - Whether to store the content of the file, or only a checksum.
           - Storing the content allows to show a diff.
+          - Cannot be V(true) if O(files[].stat_only=true).
+        type: bool
+        default: false
+      content_max_size:
+        description:
+          - If specified and O(files[].check_content=true), the content is only stored if the file is not larger than
+            this many bytes. Otherwise, only a checksum is stored.
+        type: int
+        version_added: 0.20.0
+      stat_only:
+        description:
+          - Whether to only record the attributes of the file, and neither its content nor a checksum.
+          - The file is not read at all. M(community.internal_test_tools.files_diff) can then only detect content changes
+            that also modify the file's attributes, such as its size or modification time.
+          - Cannot be V(true) if O(files[].check_content=true).
         type: bool
         default: false
+        version_added: 0.20.0
       allow_not_existing:
         description:
           - Whether to accept if the file does not exist (and mark it as a non-existing file in the output).
@@ -67,12 +87,241 @@ options:
         description:
           - Whether to store the content of the files, or only a checksum.
           - Storing the content allows to show a diff.
+          - Cannot be V(true) if O(directories[].stat_only=true).
         type: bool
         default: false
+      content_max_size:
+        description:
+          - If specified and O(directories[].check_content=true), the content of a file is only stored if it is not
+            larger than this many bytes. For larger files, only a checksum is stored.
+          - This allows to see the differences of small files such as configuration files, without storing the
+            content of large files.
+        type: int
+        version_added: 0.20.0
+      stat_only:
+        description:
+          - Whether to only record the attributes of the files, and neither their content nor a checksum.
+          - The files are not read at all. M(community.internal_test_tools.files_diff) can then only detect content changes
+            that also modify the files' attributes, such as their size or modification time.
+          - Cannot be V(true) if O(directories[].check_content=true).
+        type: bool
+        default: false
+        version_added: 0.20.0
       recursive:
-        description: Whether to consider subdirectories as well.
+        description:
+          - Whether to consider subdirectories as well.
+          - If set to V(false), O(directories[].max_depth) is ignored.
         type: bool
         default: true
+      max_depth:
+        description:
+          - The maximal depth of subdirectories to consider when O(directories[].recursive=true).
+          - V(0) means that only the files in the directory itself are considered, V(1) means that also the files in
+            its direct subdirectories are considered, and so on.
+          - In contrast to O(directories[].recursive=false), the names of the subdirectories of the deepest considered
+            directories are recorded, so that M(community.internal_test_tools.files_diff) can detect added and removed
+            subdirectories there.
+          - By default, there is no limit.
+        type: int
+        version_added: 0.20.0
+      include:
+        description:
+          - A list of shell-style patterns (see L(fnmatch,https://docs.python.org/3/library/fnmatch.html)).
+          - If specified, only files whose names match at least one of these patterns are considered.
+          - The patterns are matched against the names of files, not against their paths. Directories are not affected
+            by this option.
+        type: list
+        elements: str
+        version_added: 0.20.0
+      exclude:
+        description:
+          - A list of shell-style patterns (see L(fnmatch,https://docs.python.org/3/library/fnmatch.html)).
+          - Files and directories whose names match at least one of these patterns are ignored. Excluded directories are
+            not descended into, and are not part of the directory listings.
+          - The patterns are matched against the names of files and directories, not against their paths.
+          - M(community.internal_test_tools.files_diff) uses the same patterns when checking the directory listings.
+        type: list
+        elements: str
+        version_added: 0.20.0
+  processes:
+    description:
+      - Number of worker processes used to collect the entries of O(directories).
+      - The default V(1) collects all entries in the module's process. Higher values allow to collect multiple entries
+        concurrently in separate processes, each with O(workers) threads. This allows to use multiple CPU cores for
+        hashing, and prevents entries on slow file systems from delaying the other entries.
+      - Files with multiple hardlinks are read once per process.
+      - The returned RV(state) does not depend on this setting.
+      - Cannot be combined with O(time_budget), O(max_entries), or O(resume_from).
+    type: int
+    default: 1
+    version_added: 0.20.0
+  workers:
+    description:
+      - Number of worker threads used to read and hash file contents.
+      - The default V(1) reads all files one after another. Higher values allow to read and hash multiple files concurrently,
+        which can speed up collecting large directory trees considerably.
+      - The returned RV(state) does not depend on this setting.
+    type: int
+    default: 1
+    version_added: 0.20.0
+  tree_digests:
+    description:
+      - Whether to compute an aggregate digest for every collected directory.
+      - The digest of a directory covers its attributes, the names, attributes, and checksums or contents of its files,
+        and the names and digests of its subdirectories.
+      - M(community.internal_test_tools.files_diff) uses these digests with O(community.internal_test_tools.files_diff#module:trust_stat=true)
+        to skip unchanged directory trees as a whole.
+    type: bool
+    default: false
+    version_added: 0.20.0
+  content_compression:
+    description:
+      - How to compress the content of files stored for O(files[].check_content=true) and O(directories[].check_content=true).
+      - Compression reduces the size of the returned data, in particular for text files.
+      - V(lzma) is not available for Python 2, and for Python 3 installations without C(lzma) support.
+    type: str
+    choices:
+      none: The content is stored uncompressed.
+      zlib: The content is compressed with zlib.
+      lzma: The content is compressed with LZMA.
+    default: none
+    version_added: 0.20.0
+  deduplicate_content:
+    description:
+      - Whether to store every distinct file content only once.
+      - If set to V(true), the contents stored for O(files[].check_content=true) and O(directories[].check_content=true)
+        are stored in a table indexed by their SHA-256 checksums, and the entries for the files only reference these
+        checksums. This reduces the size of the returned data when many files have the same content.
+    type: bool
+    default: false
+    version_added: 0.20.0
+  compact_state:
+    description:
+      - Whether to return RV(state) in a compact format.
+      - In the compact format, the attributes of files and directories are stored as lists of values instead of dictionaries,
+        attributes not available on the managed node are omitted, and frequently repeated values such as owners, groups,
+        and devices are stored only once. This considerably reduces the size of the returned data for large directory trees.
+    type: bool
+    default: false
+    version_added: 0.20.0
+  digest_algorithm:
+    description:
+      - The algorithm used to compute the checksums of files whose content is not stored.
+      - The checksums are only used to detect changes, so faster algorithms than the default V(sha256) are usually sufficient.
+        V(blake2b) is a cryptographic hash that is usually considerably faster than V(sha256) on 64-bit systems, and V(sha1)
+        and V(md5) are faster as well, although they are no longer considered collision resistant.
+      - V(xxh64), V(xxh3_64), and V(xxh3_128) are very fast non-cryptographic hashes. They require the Python library
+        L(xxhash,https://pypi.org/project/xxhash/) on the managed node.
+      - V(blake2b) is not available for Python 2, and V(md5) might not be available on systems in FIPS mode.
+      - The algorithm is recorded in RV(state), and M(community.internal_test_tools.files_diff) uses the same algorithm to verify
+        the files.
+    type: str
+    choices:
+      - sha256
+      - sha1
+      - md5
+      - blake2b
+      - xxh64
+      - xxh3_64
+      - xxh3_128
+    default: sha256
+    version_added: 0.20.0
+  block_digest_threshold:
+    description:
+      - If specified, for files larger than this many bytes whose content is not stored, also the checksums of their
+        blocks of O(block_size) bytes are recorded.
+      - This allows M(community.internal_test_tools.files_diff) to report which byte ranges of a large file changed in
+        diff mode, and to stop reading a changed file at the first changed block otherwise.
+    type: int
+    version_added: 0.20.0
+  block_size:
+    description:
+      - The size in bytes of the blocks for O(block_digest_threshold).
+    type: int
+    default: 1048576
+    version_added: 0.20.0
+  state_file:
+    description:
+      - Path to a file on the managed node to write the state to.
+      - If specified, RV(state) only contains the path and the checksum of this file. M(community.internal_test_tools.files_diff)
+        reads the state from this file when RV(state) is passed to it. This avoids transferring large states between the
+        managed node and the controller.
+      - The file is overwritten if it exists, and is written also in check mode.
+    type: path
+    version_added: 0.20.0
+  time_budget:
+    description:
+      - The maximal time in seconds to spend on collecting the state.
+      - If the time is exhausted, the module stops and returns the state collected so far with RV(complete=false). Pass
+        RV(state) to O(resume_from) of another invocation of the module with the same options to continue collecting.
+      - The time is checked before every file in O(files) and before every directory, so it can be exceeded by the time
+        needed to process a single directory.
+      - If O(workers) is larger than V(1), the files found so far are read before the time is checked. This way, the
+        files of a directory are still read concurrently.
+      - At least one file or directory is processed in every invocation.
+    type: float
+    version_added: 0.20.0
+  max_entries:
+    description:
+      - The maximal number of files and directories to collect in one invocation of the module.
+      - If more files and directories have to be collected, the module stops and returns the state collected so far with
+        RV(complete=false), like when O(time_budget) is exhausted.
+      - As for O(time_budget), this is checked before every file in O(files) and before every directory, so the number
+        can be exceeded by the number of files in a single directory.
+    type: int
+    version_added: 0.20.0
+  resume_from:
+    description:
+      - An incomplete state returned by a previous invocation of this module because O(time_budget) or O(max_entries) was
+        exhausted, or the whole result of that invocation.
+      - The module continues collecting where the previous invocation stopped, and returns the combined state.
+      - All other options that affect the collected state must have the same values as for the previous invocation.
+    type: dict
+    version_added: 0.20.0
+  collect_stats:
+    description:
+      - Whether to return statistics on the work done in RV(stats).
+    type: bool
+    default: false
+    version_added: 0.20.0
+  stats_slowest_files:
+    description:
+      - The number of files which took longest to read that are listed in RV(stats.slowest_files).
+    type: int
+    default: 10
+    version_added: 0.20.0
+  previous_state:
+    description:
+      - The state returned by an earlier invocation of this module, or the whole result of that invocation.
+      - For every file whose device, inode, size, modification time, and change time did not change since then, the checksum
+        or content is taken from this state instead of reading the file again. This makes collecting the state of the same
+        files repeatedly a lot faster, since mostly only the attributes of the files have to be read.
+      - The checksum or content is only taken over if it was recorded in the form requested now, for example with the
+        same O(digest_algorithm). Files modified within two seconds before the previous state was collected are always
+        read again, since further modifications within the resolution of the timestamps could not be detected.
+      - Only states returned by community.internal_test_tools 0.20.0 or newer can be used.
+    type: dict
+    version_added: 0.20.0
+  digest_cache:
+    description:
+      - Path to a file on the managed node which caches checksums of files.
+      - The cache maps the device, inode, size, modification time, and change time of a file to its checksum. Files
+        whose attributes are found in the cache are not read again. Since the change time of a file is updated whenever
+        the file is modified, outdated cache entries are never used.
+      - The cache file is created if it does not exist, and is updated also in check mode.
+      - Files modified within the last two seconds are not added to the cache, since further modifications within the
+        resolution of the timestamps could not be detected.
+      - The same cache file can be used by M(community.internal_test_tools.files_diff), and for different values of
+        O(digest_algorithm).
+    type: path
+    version_added: 0.20.0
+  digest_cache_size:
+    description:
+      - The maximal number of entries kept in O(digest_cache).
+      - If the cache grows larger, the least recently used entries are removed.
+    type: int
+    default: 100000
+    version_added: 0.20.0
 """
 
 EXAMPLES = r"""
@@ -95,62 +344,146 @@ state:
   description:
     - The state of all files and directories.
     - Use the M(community.internal_test_tools.files_diff) module to validate against the original files.
+    - If O(state_file) is specified, only contains a reference to the state file.
     - The structure of every field in this dictionary not explicitly documented here might change at any point, or might vanish
       altogether without further notice. Do not rely on undocumented data!
   type: dict
   returned: success
+  contains:
+    state_path:
+      description:
+        - The path of the state file.
+      type: path
+      returned: success and O(state_file) is specified
+      version_added: 0.20.0
+    state_digest:
+      description:
+        - The SHA-256 checksum of the state file.
+      type: str
+      returned: success and O(state_file) is specified
+      version_added: 0.20.0
+complete:
+  description:
+    - Whether the state of all files and directories was collected.
+    - If V(false), RV(state) is incomplete since O(time_budget) or O(max_entries) was exhausted. Pass it to O(resume_from)
+      to continue collecting. Incomplete states cannot be used with M(community.internal_test_tools.files_diff).
+  type: bool
+  returned: success
+  version_added: 0.20.0
+stats:
+  description:
+    - Statistics on the work done by the module.
+  type: dict
+  returned: success and O(collect_stats=true)
+  version_added: 0.20.0
+  contains:
+    files:
+      description:
+        - The number of files visited.
+      type: int
+      returned: success
+    directories:
+      description:
+        - The number of directories visited.
+      type: int
+      returned: success
+    syscalls:
+      description:
+        - The number of file system calls made to retrieve information on files and directories, and to open files,
+          by name of the system call.
+      type: dict
+      returned: success
+      sample:
+        lstat: 1200
+        open: 1000
+        scandir: 100
+    bytes_read:
+      description:
+        - The number of bytes read from files.
+      type: int
+      returned: success
+    times:
+      description:
+        - The time in seconds spent walking directory trees (V(walk)), reading and hashing files (V(hash)), encoding file
+          contents and the state (V(encode)), and comparing (V(diff), only for M(community.internal_test_tools.files_diff)),
+          as well as the total time (V(total)).
+        - The times of files read concurrently by multiple worker threads are added up.
+      type: dict
+      returned: success
+      sample:
+        walk: 0.12
+        hash: 1.5
+        encode: 0.01
+        diff: 0.0
+        total: 1.7
+    slowest_files:
+      description:
+        - The files which took longest to read, with their size in bytes and the time in seconds, slowest first.
+        - The number of files is limited by O(stats_slowest_files).
+      type: list
+      elements: dict
+      returned: success
+      sample:
+        - path: /path/to/file
+          size: 1048576
+          time: 0.2
 """
 
-import os
-import base64
 import hashlib
+import json
+import os
 import sys
+import time
 
 from ansible.module_utils.basic import AnsibleModule
 
+from ansible_collections.community.internal_test_tools.plugins.module_utils.collect import (
+    CollectError,
+    add_file,
+    collect_directories_in_processes,
+    collect_directory,
+    store_contents,
+)
+
+from ansible_collections.community.internal_test_tools.plugins.module_utils.digest_cache import (
+    DigestCache,
+)
+
+from ansible_collections.community.internal_test_tools.plugins.module_utils.stats import (
+    Stats,
+)
+
 from ansible_collections.community.internal_test_tools.plugins.module_utils.state import (
+    DEFAULT_BLOCK_SIZE,
+    DEFAULT_DIGEST_ALGORITHM,
     STATE_VERSION,
-    read_file,
-    extract_stat,
+    FileDigester,
+    PreviousState,
+    create_digest,
+    add_tree_digests,
+    ContentStore,
+    compact_state,
+    write_state_file,
+    get_compressions,
+    load_state,
 )
 
 if sys.version_info[0] >= 3:
     import typing as t
 
 
-def add_file(
-    module,  # type: AnsibleModule
-    files,  # type: dict[str, dict[str, t.Any]]
-    path,  # type: str
-    check_content=True,  # type: bool
-    allow_not_existing=False,  # type: bool
-):
-    # type: (...) -> None
-    result = {}  # type: dict[str, t.Any]
-    files[path] = result
-
-    if not os.path.exists(path):
-        if not allow_not_existing:
-            module.fail_json(msg='The file "{path}" does not exist'.format(path=path))
-        result['exists'] = False
-        return
-
-    stat = os.lstat(path)
-    result['stat'] = extract_stat(stat)
-
-    if os.path.islink(path):
-        # Record symlink information
-        result['symlink'] = os.readlink(path)
-        return
-    elif os.path.isfile(path):
-        # Record file content
-        content = read_file(module, path)
-        if check_content:
-            result['content'] = base64.b64encode(content)
-        else:
-            result['sha256'] = hashlib.sha256(content).hexdigest()
-    else:
-        module.fail_json('The path "{path}" is not a file or symlink - this is not yet supported!'.format(path=path))  # pragma: no cover
+# Options that do not affect the collected state, and can be changed when resuming
+RESUME_INDEPENDENT_OPTIONS = (
+    'workers', 'processes', 'compact_state', 'time_budget', 'max_entries', 'resume_from', 'collect_stats', 'stats_slowest_files',
+    'state_file', 'previous_state', 'digest_cache', 'digest_cache_size',
+)
+
+
+def get_options_digest(params):
+    # type: (dict[str, t.Any]) -> str
+    # Compute a digest of the options that affect the collected state
+    options = dict((key, value) for key, value in params.items() if key not in RESUME_INDEPENDENT_OPTIONS)
+    return hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8')).hexdigest()
 
 
 def main():
@@ -159,58 +492,255 @@ def main():
         files=dict(type='list', elements='dict', options=dict(
             path=dict(type='path', required=True),
             check_content=dict(type='bool', default=False),
+            content_max_size=dict(type='int'),
+            stat_only=dict(type='bool', default=False),
             allow_not_existing=dict(type='bool', default=False),
         )),
         directories=dict(type='list', elements='dict', options=dict(
             path=dict(type='path', required=True),
             check_content=dict(type='bool', default=False),
+            content_max_size=dict(type='int'),
+            stat_only=dict(type='bool', default=False),
             recursive=dict(type='bool', default=True),
+            max_depth=dict(type='int'),
+            include=dict(type='list', elements='str'),
+            exclude=dict(type='list', elements='str'),
         )),
+        workers=dict(type='int', default=1),
+        processes=dict(type='int', default=1),
+        tree_digests=dict(type='bool', default=False),
+        compact_state=dict(type='bool', default=False),
+        content_compression=dict(type='str', choices=['none', 'zlib', 'lzma'], default='none'),
+        deduplicate_content=dict(type='bool', default=False),
+        digest_algorithm=dict(
+            type='str', default=DEFAULT_DIGEST_ALGORITHM,
+            choices=['sha256', 'sha1', 'md5', 'blake2b', 'xxh64', 'xxh3_64', 'xxh3_128'],
+        ),
+        block_digest_threshold=dict(type='int'),
+        block_size=dict(type='int', default=DEFAULT_BLOCK_SIZE),
+        time_budget=dict(type='float'),
+        max_entries=dict(type='int'),
+        resume_from=dict(type='dict'),
+        collect_stats=dict(type='bool', default=False),
+        stats_slowest_files=dict(type='int', default=10),
+        state_file=dict(type='path'),
+        previous_state=dict(type='dict'),
+        digest_cache=dict(type='path'),
+        digest_cache_size=dict(type='int', default=100000),
     )
     module = AnsibleModule(
         argument_spec=argument_spec,
         supports_check_mode=True,
     )
 
+    workers = module.params['workers']
+    if workers < 1:
+        module.fail_json(msg='workers must be at least 1')
+
+    processes = module.params['processes']
+    if processes < 1:
+        module.fail_json(msg='processes must be at least 1')
+    if processes > 1 and any(module.params[option] is not None for option in ('time_budget', 'max_entries', 'resume_from')):
+        module.fail_json(msg='processes cannot be larger than 1 if time_budget, max_entries, or resume_from is specified')
+
+    compression = module.params['content_compression']
+    if compression == 'none':
+        compression = None
+    elif compression not in get_compressions():
+        module.fail_json(msg='The content compression {0} is not supported by the Python interpreter on the managed node'.format(compression))
+
+    algorithm = module.params['digest_algorithm']
+    try:
+        create_digest(algorithm)
+    except ValueError:
+        module.fail_json(msg='The digest algorithm {0} is not supported by the Python interpreter on the managed node'.format(algorithm))
+
+    if module.params['block_digest_threshold'] is not None and module.params['block_digest_threshold'] < 0:
+        module.fail_json(msg='block_digest_threshold must not be negative')
+    if module.params['block_size'] < 1:
+        module.fail_json(msg='block_size must be at least 1')
+
+    if module.params['digest_cache_size'] < 1:
+        module.fail_json(msg='digest_cache_size must be at least 1')
+
+    stats = None
+    if module.params['collect_stats']:
+        if module.params['stats_slowest_files'] < 0:
+            module.fail_json(msg='stats_slowest_files must not be negative')
+        stats = Stats(slowest_files=module.params['stats_slowest_files'])
+
+    previous = None
+    if module.params['previous_state'] is not None:
+        previous = PreviousState(load_state(module, module.params['previous_state'], 'previous_state'))
+
+    if module.params['time_budget'] is not None and module.params['time_budget'] < 0:
+        module.fail_json(msg='time_budget must not be negative')
+
+    if module.params['max_entries'] is not None and module.params['max_entries'] < 1:
+        module.fail_json(msg='max_entries must be at least 1')
+
+    for directory in module.params['directories'] or []:
+        if directory['max_depth'] is not None and directory['max_depth'] < 0:
+            module.fail_json(msg='max_depth must not be negative for "{path}"'.format(path=directory['path']))
+
+    for entry in (module.params['files'] or []) + (module.params['directories'] or []):
+        if entry['check_content'] and entry['stat_only']:
+            module.fail_json(msg='check_content and stat_only cannot both be true for "{path}"'.format(path=entry['path']))
+        if entry['content_max_size'] is not None and entry['content_max_size'] < 0:
+            module.fail_json(msg='content_max_size must not be negative for "{path}"'.format(path=entry['path']))
+
+    # Files modified after this time are not considered unchanged by later invocations with previous_state
+    timestamp = time.time()
     files = dict()  # type: dict[str, dict[str, t.Any]]
     directories = dict()  # type: dict[str, dict[str, t.Any]]
+    contents = dict()  # type: dict[str, dict[str, t.Any]]
+    options_digest = get_options_digest(module.params)
+    # The position where the previous invocation stopped: the index of the next entry of files and directories, and the
+    # stack of directories still to be walked for that entry of directories
+    position = dict(files=0, directories=0, stack=[])  # type: dict[str, t.Any]
 
-    for file in module.params['files'] or []:
-        add_file(
-            module,
-            files,
-            file['path'],
-            check_content=file['check_content'],
-            allow_not_existing=file['allow_not_existing'],
-        )
+    if module.params['resume_from'] is not None:
+        resume_state = load_state(module, module.params['resume_from'], 'resume_from')
+        if 'resume' not in resume_state:
+            module.fail_json(msg='The state passed to resume_from is already complete')
+        position = resume_state['resume']
+        if position['options'] != options_digest:
+            module.fail_json(msg='The options differ from the ones used to collect the state passed to resume_from')
+        timestamp = resume_state['timestamp']
+        files = resume_state['files']
+        directories = resume_state['directories']
+        contents = resume_state.get('contents') or {}
 
-    for directory in module.params['directories'] or []:
-        for dirpath, dirnames, filenames in os.walk(directory['path']):
-            for file in filenames:
-                add_file(
-                    module,
-                    files,
-                    os.path.join(directory['path'], dirpath, file),
-                    check_content=directory['check_content'],
-                    allow_not_existing=False,
-                )
-            directory_entry = {}  # type: dict[str, t.Any]
-            directories[os.path.join(directory['path'], dirpath)] = directory_entry
-
-            stat = os.lstat(os.path.join(directory['path'], dirpath))
-            directory_entry['stat'] = extract_stat(stat)
-
-            directory_entry['files'] = filenames
-            if not directory['recursive']:
-                break
-            directory_entry['directories'] = dirnames
-
-    module.exit_json(state=dict(
+    max_entries = module.params['max_entries']
+    deadline = None if module.params['time_budget'] is None else time.time() + module.params['time_budget']
+    initial_entries = len(files) + len(directories)
+
+    def is_budget_exhausted():
+        # type: () -> bool
+        entries = len(files) + len(directories) - initial_entries
+        if entries == 0:
+            # Make sure that every invocation makes progress
+            return False
+        if deadline is not None and pending:
+            # Read the files found so far, so that the time needed for this is accounted for
+            store_contents(digester, pending, workers, content_store)
+            del pending[:]
+        return (max_entries is not None and entries >= max_entries) or (deadline is not None and time.time() >= deadline)
+
+    resume = None  # type: dict[str, t.Any] | None
+    pending = [] if workers > 1 else None  # type: list[tuple[str, dict[str, t.Any], bool, os.stat_result]] | None
+
+    cache = None
+    if module.params['digest_cache'] is not None:
+        cache = DigestCache(module.params['digest_cache'], module.params['digest_cache_size'], algorithm=algorithm)
+    digester = FileDigester(
+        module,
+        cache=cache,
+        algorithm=algorithm,
+        block_digest_threshold=module.params['block_digest_threshold'],
+        block_size=module.params['block_size'],
+        stats=stats,
+    )
+    content_store = ContentStore(compression=compression, deduplicate=module.params['deduplicate_content'])
+    content_store.contents = contents
+
+    for index, file in enumerate(module.params['files'] or []):
+        if index < position['files']:
+            continue
+        if is_budget_exhausted():
+            resume = dict(files=index, directories=0, stack=[])
+            break
+        try:
+            add_file(
+                digester,
+                files,
+                file['path'],
+                check_content=file['check_content'],
+                allow_not_existing=file['allow_not_existing'],
+                stat_only=file['stat_only'],
+                content_max_size=file['content_max_size'],
+                pending=pending,
+                content_store=content_store,
+                previous=previous,
+            )
+        except CollectError as exc:
+            module.fail_json(msg=str(exc))
+
+    if processes > 1 and len(module.params['directories'] or []) > 1:
+        # Collect the entries in worker processes; the budget options are not allowed in this case
+        try:
+            collect_directories_in_processes(
+                digester, files, directories, module.params['directories'], processes, workers, content_store, previous=previous,
+            )
+        except CollectError as exc:
+            module.fail_json(msg=str(exc))
+        position['directories'] = len(module.params['directories'])
+
+    for index, directory in enumerate(module.params['directories'] or []):
+        if resume is not None:
+            break
+        if index < position['directories']:
+            continue
+        stack = []  # type: list[tuple[str, os.stat_result | None, int]]
+        if index == position['directories']:
+            stack = [(path, None, depth) for path, depth in position['stack']]
+        elif is_budget_exhausted():
+            resume = dict(files=len(module.params['files'] or []), directories=index, stack=[])
+            break
+        try:
+            collect_directory(
+                digester, files, directories, directory, pending=pending, content_store=content_store, previous=previous,
+                stack=stack, should_stop=is_budget_exhausted,
+            )
+        except CollectError as exc:
+            module.fail_json(msg=str(exc))
+        if stack:
+            # The walk was interrupted since the budget is exhausted
+            resume = dict(
+                files=len(module.params['files'] or []),
+                directories=index,
+                stack=[(path, depth) for path, dummy, depth in stack],
+            )
+
+    if pending:
+        store_contents(digester, pending, workers, content_store)
+
+    if module.params['tree_digests'] and resume is None:
+        add_tree_digests(files, directories)
+
+    if cache is not None:
+        try:
+            cache.save()
+        except (IOError, OSError) as exc:
+            module.warn('Cannot write digest cache {path}: {exc}'.format(path=cache.path, exc=exc))
+
+    state = dict(
         changed=False,
         version=STATE_VERSION,
+        timestamp=timestamp,
         files=files,
         directories=directories,
-    ))
+    )
+    if algorithm != DEFAULT_DIGEST_ALGORITHM:
+        state['digest_algorithm'] = algorithm
+    if content_store.deduplicate:
+        state['contents'] = content_store.contents
+    if resume is not None:
+        resume['options'] = options_digest
+        state['resume'] = resume
+    encode_start = time.time()
+    if module.params['compact_state']:
+        state = compact_state(state)
+    if module.params['state_file'] is not None:
+        state_path = module.params['state_file']
+        try:
+            state = dict(state_path=state_path, state_digest=write_state_file(state_path, state))
+        except (IOError, OSError) as exc:
+            module.fail_json(msg='Cannot write state file {path}: {exc}'.format(path=state_path, exc=exc))
+    if stats is not None:
+        stats.add_time('encode', time.time() - encode_start)
+        module.exit_json(state=state, complete=resume is None, stats=stats.get_result())
+    module.exit_json(state=state, complete=resume is None)
 
 
 if __name__ == '__main__':
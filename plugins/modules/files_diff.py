@@ -21,28 +21,115 @@ description:
     collected information on earlier.
 extends_documentation_fragment:
   - community.internal_test_tools.attributes
-  - community.internal_test_tools.attributes.idempotent_not_modify_state
 attributes:
   check_mode:
     support: full
     details:
-      - This action does not modify state.
+      - This action does not modify state, except that the file specified in O(digest_cache) is written. This also happens in
+        check mode.
   diff_mode:
     support: partial
     details:
       - This action does not modify state.
       - In diff mode, shows the differences of the current state compared to O(state).
+      - For files with block checksums (see O(community.internal_test_tools.files_collect#module:block_digest_threshold)),
+        the changed byte ranges are shown in diff mode. Otherwise, reading such a file stops at the first changed block.
+      - For directories with more than 1000 entries before or after the change, only the first added and removed names are
+        shown instead of a diff of the directory listings.
+  idempotent:
+    support: full
+    details:
+      - This action does not modify state, except that the file specified in O(digest_cache) is written.
 options:
   state:
     required: true
     description:
       - The state returned by M(community.internal_test_tools.files_collect).
+      - If the state was written to a file on the managed node with
+        O(community.internal_test_tools.files_collect#module:state_file), the state is read from that file.
     type: dict
   fail_on_diffs:
     description:
       - Whether to fail when differences are found, instead of simply returning RV(changed=true).
     type: bool
     default: false
+  trust_stat:
+    description:
+      - Whether to assume that the content of a file did not change if none of its attributes changed.
+      - The attributes include the size, the inode, and the modification and change times. Since the change time is updated
+        by the kernel whenever the file is written to, it is very unlikely that the content changed without the attributes
+        being modified as well.
+      - If set to V(true), files whose attributes did not change are not read, which makes checking large files or directory
+        trees a lot faster.
+      - If the state was collected with O(community.internal_test_tools.files_collect#module:tree_digests=true), the aggregate
+        digests of the directories are recomputed from the current directory listings and attributes. Directory trees whose
+        digest did not change are skipped as a whole.
+    type: bool
+    default: false
+    version_added: 0.20.0
+  workers:
+    description:
+      - Number of worker threads used to check files.
+      - The default V(1) checks all files one after another. Higher values allow to read and hash multiple files concurrently,
+        which can speed up checking large directory trees considerably.
+      - The result does not depend on this setting.
+    type: int
+    default: 1
+    version_added: 0.20.0
+  collect_stats:
+    description:
+      - Whether to return statistics on the work done in RV(stats).
+    type: bool
+    default: false
+    version_added: 0.20.0
+  stats_slowest_files:
+    description:
+      - The number of files which took longest to read that are listed in RV(stats.slowest_files).
+    type: int
+    default: 10
+    version_added: 0.20.0
+  digest_cache:
+    description:
+      - Path to a file on the managed node which caches checksums of files.
+      - See O(community.internal_test_tools.files_collect#module:digest_cache) for details.
+      - The cache file is created if it does not exist, and is updated also in check mode.
+      - The checksums are computed with the algorithm recorded in O(state),
+        see O(community.internal_test_tools.files_collect#module:digest_algorithm).
+    type: path
+    version_added: 0.20.0
+  digest_cache_size:
+    description:
+      - The maximal number of entries kept in O(digest_cache).
+      - If the cache grows larger, the least recently used entries are removed.
+    type: int
+    default: 100000
+    version_added: 0.20.0
+  quick_check:
+    description:
+      - Whether to only determine whether anything changed.
+      - If set to V(true), checking stops at the first difference found. The path of the changed file or directory is returned
+        in RV(first_difference), and no other information on the differences is returned. No diff is shown in diff mode.
+      - The cheapest checks are done first. First the attributes and listings of all directories are compared, then the
+        attributes of all files, and only then the contents of the files are read.
+      - O(workers) is ignored, since the checks are done one after another.
+    type: bool
+    default: false
+    version_added: 0.20.0
+  tree_diff:
+    description:
+      - Whether to walk every collected directory tree once and report all added files and directories at any depth.
+      - By default, a directory that was added to a collected directory is only reported in RV(added_dirs), and its content is
+        not looked at. If set to V(true), all files and directories in added directories are reported in RV(added_files)
+        and RV(added_dirs) as well.
+      - Every directory is listed with the include and exclude filters it was collected with. Added directories are listed
+        with the filters of their parent directory.
+      - Added directories below the depth given by
+        O(community.internal_test_tools.files_collect#module:directories[].max_depth) are not looked into. This way, the
+        same files and directories are reported as would be collected again.
+      - This is ignored if O(quick_check=true).
+    type: bool
+    default: false
+    version_added: 0.20.0
 """
 
 EXAMPLES = r"""
@@ -73,21 +160,21 @@ changed_content:
     - Whether any file content changed. This does not consider added or removed files, or files which were converted to links
       or converted from links.
   type: bool
-  returned: success
+  returned: success and O(quick_check=false)
   sample: true
 added_files:
   description:
     - A list of files that were added.
   type: list
   elements: path
-  returned: success
+  returned: success and O(quick_check=false)
   sample: [file_a.txt, dir/file_b]
 removed_files:
   description:
     - A list of files that were removed.
   type: list
   elements: path
-  returned: success
+  returned: success and O(quick_check=false)
   sample: [file_a.txt, dir/file_b]
 changed_files:
   description:
@@ -95,7 +182,7 @@ changed_files:
     - Attribute changes, times changes, inode changes, symlink changes, and content changes are considered.
   type: list
   elements: path
-  returned: success
+  returned: success and O(quick_check=false)
   sample: [file_a.txt, dir/file_b]
 changed_files_content:
   description:
@@ -103,60 +190,135 @@ changed_files_content:
     - B(Only) content changes are considered.
   type: list
   elements: path
-  returned: success
+  returned: success and O(quick_check=false)
   sample: [file_a.txt, dir/file_b]
 added_dirs:
   description:
     - A list of directories that have been added.
   type: list
   elements: path
-  returned: success
+  returned: success and O(quick_check=false)
   sample: [dir_a, dir/dir_b]
 removed_dirs:
   description:
     - A list of directories that have been removed.
   type: list
   elements: path
-  returned: success
+  returned: success and O(quick_check=false)
   sample: [dir_a, dir/dir_b]
 changed_dirs:
   description:
     - A list of directories that have been changed.
   type: list
   elements: path
-  returned: success
+  returned: success and O(quick_check=false)
   sample: [dir_a, dir/dir_b]
+first_difference:
+  description:
+    - The path of the first file or directory for which a difference was found.
+    - V(null) if no difference was found.
+  type: path
+  returned: success and O(quick_check=true)
+  sample: dir/file_b
+  version_added: 0.20.0
+stats:
+  description:
+    - Statistics on the work done by the module.
+    - See RV(community.internal_test_tools.files_collect#module:stats) for a description of the statistics.
+  type: dict
+  returned: success and O(collect_stats=true)
+  version_added: 0.20.0
 """
 
 import os
-import base64
 import difflib
 import hashlib
+import heapq
 import sys
+import time
+
+from multiprocessing.pool import ThreadPool
 
 from ansible.module_utils.basic import AnsibleModule
 
+from ansible_collections.community.internal_test_tools.plugins.module_utils.digest_cache import (
+    DigestCache,
+)
+
+from ansible_collections.community.internal_test_tools.plugins.module_utils.stats import (
+    Stats,
+)
+
 from ansible_collections.community.internal_test_tools.plugins.module_utils.state import (
-    STATE_VERSION,
-    read_file,
+    DEFAULT_DIGEST_ALGORITHM,
+    FileDigester,
+    create_digest,
+    decode_content,
+    load_state,
+    has_content,
+    is_regular_file,
+    is_symlink,
+    iter_block_digests,
+    iter_directories_bottom_up,
+    list_directory,
     extract_stat,
+    scan_directory,
+    tree_digest,
 )
 
 if sys.version_info[0] >= 3:
     import typing as t
 
 
-def compare_stat(ex_stat, path, differences_neg, differences_pos):
-    # type: (dict[str, t.Any], str, list[str], list[str]) -> None
-    stat = extract_stat(os.lstat(path))
+def compare_stat(ex_stat, stat_result, differences_neg, differences_pos):
+    # type: (dict[str, t.Any], os.stat_result, list[str], list[str]) -> bool
+    stat = extract_stat(stat_result)
+    changed = False
     for k in stat:
         if stat[k] != ex_stat[k]:
+            changed = True
             differences_neg.append('-  {key}: {value}'.format(key=k, value=ex_stat[k]))
             differences_pos.append('+  {key}: {value}'.format(key=k, value=stat[k]))
+    return changed
+
+
+def find_changed_blocks(digester, path, file, find_all):
+    # type: (FileDigester, str, dict[str, t.Any], bool) -> tuple[list[tuple[int, int]], str | None]
+    # Compare the blocks of the file with the recorded block digests. Returns the changed byte ranges (the ends are
+    # exclusive), and the digest of the whole file. If find_all is false, stops reading at the first changed block,
+    # and the digest of the whole file is not computed.
+    ex_blocks = file['block_digests']  # type: list[str]
+    block_size = file['block_size']  # type: int
+    digest = create_digest(digester.algorithm) if find_all else None
+    ranges = []  # type: list[tuple[int, int]]
+
+    def add_range(start, end):
+        # type: (int, int) -> None
+        if ranges and ranges[-1][1] == start:
+            start = ranges.pop()[0]
+        ranges.append((start, end))
+
+    with open(path, 'rb') as f:
+        for index, block_digest in enumerate(iter_block_digests(f, block_size, algorithm=digester.algorithm, digest=digest)):
+            if index >= len(ex_blocks) or block_digest != ex_blocks[index]:
+                add_range(index * block_size, f.tell())
+                if not find_all:
+                    break
+        else:
+            # The file has been truncated
+            size = f.tell()
+            if size < file['stat']['size']:
+                add_range(size, file['stat']['size'])
+    return ranges, digest.hexdigest() if digest is not None else None
+
+
+class CheckError(Exception):
+    pass
 
 
 def check_file(
     module,  # type: AnsibleModule
+    digester,  # type: FileDigester
     path,  # type: str
     file,  # type: dict[str, t.Any]
     global_differences,  # type: list[str]
@@ -164,14 +326,36 @@ def check_file(
     changed_files_content,  # type: set[str]
     added_files,  # type: set[str]
     removed_files,  # type: set[str]
+    trust_stat=False,  # type: bool
+    contents=None,  # type: dict[str, dict[str, t.Any]] | None
+    check_content=True,  # type: bool
+    quick=False,  # type: bool
 ):
     # type: (...) -> None
+    # If check_content is false, only the existence, the attributes, and the type of the file are compared. If quick is
+    # true, only determine whether the file changed, without finding all changed blocks or creating content diffs.
     differences_neg = []
     differences_pos = []
     differences = []
 
+    stats = digester.stats
+    if stats is not None:
+        stats.visit(files=1)
+        stats.count('lstat')
+
+    # A single lstat() provides the existence, the type, and the attributes of the file. Only for symlinks, the
+    # existence of the link target has to be checked separately.
+    try:
+        stat = os.lstat(path)  # type: os.stat_result | None
+    except OSError:
+        stat = None
+    exists = stat is not None
+    if stat is not None and is_symlink(stat):
+        if stats is not None:
+            stats.count('stat')
+        exists = os.path.exists(path)
+
     ex_exist = file.get('exists', True)
-    exists = os.path.exists(path)
     if ex_exist != exists:
         differences_neg.append('-  exists: {0}'.format(ex_exist))
         differences_pos.append('+  exists: {0}'.format(exists))
@@ -180,36 +364,71 @@ def check_file(
         else:
             added_files.add(path)
 
-    if exists and 'stat' in file:
-        compare_stat(file['stat'], path, differences_neg, differences_pos)
+    if stat is not None and exists and 'stat' in file:
+        stat_changed = compare_stat(file['stat'], stat, differences_neg, differences_pos)
 
         ex_symlink = file.get('symlink')
-        symlink = os.readlink(path) if os.path.islink(path) else None
+        symlink = None
+        if is_symlink(stat):
+            if stats is not None:
+                stats.count('readlink')
+            symlink = os.readlink(path)
         if ex_symlink != symlink:
             differences_neg.append('-  link: {0}'.format('(not a link)' if ex_symlink is None else ex_symlink))
             differences_pos.append('+  link: {0}'.format('(not a link)' if symlink is None else symlink))
 
         if symlink is None:
-            if not os.path.isfile(path):
+            if not is_regular_file(stat):
                 differences_neg.append('-  type: {type}'.format(type='link' if ex_symlink is not None else 'file'))
                 differences_pos.append('+  type: {type}'.format(type='directory' if os.path.isdir(path) else '???'))
-            else:
-                content = read_file(module, path)
-
-                if 'sha256' in file:
-                    ex_sha256 = file['sha256']
-                    sha256 = hashlib.sha256(content).hexdigest()
-                    if sha256 != ex_sha256:
+            elif check_content and (stat_changed or not trust_stat):
+                # If the size changed, so did the content, and the file does not need to be read. In diff mode, the file
+                # is still read to show what changed.
+                size_changed = stat.st_size != file['stat']['size']
+                read_content = not size_changed or (module._diff and not quick)
+                if digester.algorithm in file:
+                    ex_digest = file[digester.algorithm]
+                    label = 'SHA-256' if digester.algorithm == 'sha256' else digester.algorithm
+                    if not read_content:
                         changed_files_content.add(path)
-                        differences_neg.append('-  SHA-256: {0}'.format(ex_sha256))
-                        differences_pos.append('+  SHA-256: {0}'.format(sha256))
-
-                if 'content' in file:
-                    ex_content = base64.b64decode(file['content'])
-                    if content != ex_content:
+                        differences_neg.append('-  {0}: {1}'.format(label, ex_digest))
+                        differences_pos.append('+  {0}: (...)'.format(label))
+                    elif 'block_digests' in file and digester.cached_digest(stat) != ex_digest:
+                        ranges, digest = find_changed_blocks(digester, path, file, find_all=module._diff and not quick)
+                        if ranges:
+                            changed_files_content.add(path)
+                            differences_neg.append('-  {0}: {1}'.format(label, ex_digest))
+                            differences_pos.append('+  {0}: {1}'.format(label, digest or '(...)'))
+                            differences.append('   {0}: {1}'.format(
+                                'Changed bytes' if module._diff and not quick else 'First changed bytes',
+                                ', '.join('{0}-{1}'.format(start, end - 1) for start, end in ranges),
+                            ))
+                    else:
+                        digest = digester.digest(path, stat)
+                        if digest != ex_digest:
+                            changed_files_content.add(path)
+                            differences_neg.append('-  {0}: {1}'.format(label, ex_digest))
+                            differences_pos.append('+  {0}: {1}'.format(label, digest))
+
+                if has_content(file):
+                    if not read_content:
+                        content_changed = True
+                    elif 'content_digest' in file and not (module._diff and not quick):
+                        # Deduplicated contents are referenced by their SHA-256 digest, which can be compared
+                        # without decoding and decompressing the recorded content
+                        content = digester.content(path, stat)
+                        content_changed = hashlib.sha256(content).hexdigest() != file['content_digest']
+                    else:
+                        content = digester.content(path, stat)
+                        try:
+                            ex_content = decode_content(file, contents=contents)
+                        except ValueError as exc:
+                            raise CheckError('Cannot decode the recorded content of "{path}": {exc}'.format(path=path, exc=exc))
+                        content_changed = content != ex_content
+                    if content_changed:
                         changed_files_content.add(path)
                         differences.append('   Content:')
-                        if module._diff:
+                        if module._diff and not quick:
                             ex_lines = ex_content.decode('utf-8').splitlines(False)
                             lines = content.decode('utf-8').splitlines(False)
                             differences.extend([line.rstrip('\n') for line in difflib.unified_diff(ex_lines, lines, n=3)])
@@ -226,9 +445,288 @@ def check_file(
         ))
 
 
-def is_state(state):
-    # type: (dict[str, t.Any]) -> bool
-    return 'files' in state and 'directories' in state and state.get('version') == STATE_VERSION
+def check_files(
+    module,  # type: AnsibleModule
+    digester,  # type: FileDigester
+    files,  # type: list[tuple[str, dict[str, t.Any]]]
+    workers,  # type: int
+    global_differences,  # type: list[str]
+    changed_files,  # type: set[str]
+    changed_files_content,  # type: set[str]
+    added_files,  # type: set[str]
+    removed_files,  # type: set[str]
+    trust_stat=False,  # type: bool
+    contents=None,  # type: dict[str, dict[str, t.Any]] | None
+):
+    # type: (...) -> None
+    # Check the (path, file) pairs in files with check_file(). With more than one worker, the files are checked
+    # concurrently, and the results are merged in the order of files, so that they do not depend on the number of workers.
+    if workers <= 1 or len(files) <= 1:
+        for path, file in files:
+            check_file(
+                module, digester, path, file, global_differences, changed_files, changed_files_content, added_files, removed_files,
+                trust_stat=trust_stat, contents=contents,
+            )
+        return
+
+    def process(job):
+        # type: (tuple[str, dict[str, t.Any]]) -> tuple[list[str], set[str], set[str], set[str], set[str]]
+        result = ([], set(), set(), set(), set())  # type: tuple[list[str], set[str], set[str], set[str], set[str]]
+        check_file(module, digester, job[0], job[1], result[0], result[1], result[2], result[3], result[4], trust_stat=trust_stat, contents=contents)
+        return result
+
+    pool = ThreadPool(min(workers, len(files)))
+    try:
+        results = pool.map(process, files, chunksize=16)
+    finally:
+        pool.close()
+        pool.join()
+    for differences, job_changed_files, job_changed_files_content, job_added_files, job_removed_files in results:
+        global_differences.extend(differences)
+        changed_files.update(job_changed_files)
+        changed_files_content.update(job_changed_files_content)
+        added_files.update(job_added_files)
+        removed_files.update(job_removed_files)
+
+
+# Listings with more names than this are not compared with a unified diff; only a summary of the differences is shown
+LISTING_DIFF_MAX_NAMES = 1000
+
+# The maximal number of added and removed names each that are shown in the summary
+LISTING_SUMMARY_MAX_NAMES = 20
+
+
+def diff_listing(path, kind, ex_names, names):
+    # type: (str, str, set[str], set[str]) -> str
+    # Returns the difference between the recorded and the current listing. For huge listings, only the first removed
+    # and added names are shown, instead of a unified diff of both full listings.
+    modified = '{path} ({kind})'.format(path=path, kind=kind)
+    if max(len(ex_names), len(names)) <= LISTING_DIFF_MAX_NAMES:
+        return '\n'.join([
+            line.rstrip('\n') for line in difflib.unified_diff(sorted(ex_names), sorted(names), modified, modified, n=3)])
+    lines = ['--- {0}'.format(modified), '+++ {0}'.format(modified)]
+    for prefix, changed_names, change in (('-', ex_names - names, 'removed'), ('+', names - ex_names, 'added')):
+        lines.extend('{0}{1}'.format(prefix, name) for name in heapq.nsmallest(LISTING_SUMMARY_MAX_NAMES, changed_names))
+        if len(changed_names) > LISTING_SUMMARY_MAX_NAMES:
+            lines.append('{0}(... {1} more {2})'.format(prefix, len(changed_names) - LISTING_SUMMARY_MAX_NAMES, change))
+    return '\n'.join(lines)
+
+
+def check_directory(
+    path,  # type: str
+    directory,  # type: dict[str, t.Any]
+    global_differences,  # type: list[str]
+    added_files,  # type: set[str]
+    added_dirs,  # type: set[str]
+    removed_dirs,  # type: set[str]
+    changed_dirs,  # type: set[str]
+    stats=None,  # type: Stats | None
+    quick=False,  # type: bool
+    listing=None,  # type: tuple[os.stat_result, list[str], list[str]] | None
+):
+    # type: (...) -> None
+    # If quick is true, only determine whether the directory changed, without creating diffs of the listings.
+    # listing can provide the lstat() result, the subdirectories, and the files of the directory if they are already known.
+    if listing is not None:
+        dirstat, dirnames, filenames = listing  # type: tuple[os.stat_result | None, list[str] | None, list[str] | None]
+    else:
+        if stats is not None:
+            stats.visit(directories=1)
+            stats.count('stat')
+        if not os.path.isdir(path):
+            removed_dirs.add(path)
+            return
+        dirstat = os.lstat(path) if 'stat' in directory else None
+        dirnames = None
+        filenames = None
+        list_start = time.time()
+        try:
+            dirnames, filenames = list_directory(path, include=directory.get('include'), exclude=directory.get('exclude'))
+        except OSError:
+            # The directory cannot be listed; ignore this, like os.walk() did
+            pass
+        if stats is not None:
+            stats.add_time('walk', time.time() - list_start)
+            stats.count('lstat')
+            stats.count('scandir')
+    changed = False
+    if 'stat' in directory and dirstat is not None:
+        differences_neg = []  # type: list[str]
+        differences_pos = []  # type: list[str]
+        compare_stat(directory['stat'], dirstat, differences_neg, differences_pos)
+        if differences_neg or differences_pos:
+            changed = True
+            global_differences.append('--- {path}\n+++ {path}\n{diffs}'.format(
+                path=path,
+                diffs='\n'.join(differences_neg + differences_pos),
+            ))
+    if filenames is not None and 'files' in directory:
+        ex_files = set(directory['files'])
+        files = set(filenames)
+        if ex_files != files:
+            changed = True
+            added_files.update(os.path.join(path, file) for file in files - ex_files)
+            if not quick:
+                global_differences.append(diff_listing(path, 'files', ex_files, files))
+    if dirnames is not None and 'directories' in directory:
+        ex_dirs = set(directory['directories'])
+        dirs = set(dirnames)
+        if ex_dirs != dirs:
+            changed = True
+            removed_dirs.update(os.path.join(path, dir) for dir in ex_dirs - dirs)
+            added_dirs.update(os.path.join(path, dir) for dir in dirs - ex_dirs)
+            if not quick:
+                global_differences.append(diff_listing(path, 'dirs', ex_dirs, dirs))
+    if changed:
+        changed_dirs.add(path)
+
+
+def find_tree_roots(directories):
+    # type: (dict[str, dict[str, t.Any]]) -> list[str]
+    # Returns the directories of a state which are not listed as a subdirectory by another directory of the state
+    children = set()  # type: set[str]
+    for path, directory in directories.items():
+        children.update(os.path.join(path, name) for name in directory.get('directories') or [])
+    return sorted(path for path in directories if path not in children)
+
+
+def check_tree(
+    root,  # type: str
+    directories,  # type: dict[str, dict[str, t.Any]]
+    unchanged_dirs,  # type: set[str]
+    visited,  # type: set[str]
+    global_differences,  # type: list[str]
+    added_files,  # type: set[str]
+    added_dirs,  # type: set[str]
+    removed_dirs,  # type: set[str]
+    changed_dirs,  # type: set[str]
+    stats=None,  # type: Stats | None
+):
+    # type: (...) -> None
+    # Walk the directory tree at root once and compare every directory with its entry in directories, listing it with
+    # the filters recorded for it. Directories which are not part of the state are reported as added together with all
+    # their contents, and are listed with the filters of their parent. The walk descends into all subdirectories which
+    # were collected, and into added subdirectories up to the depth up to which the tree was collected. Symlinks to
+    # directories are not followed. The paths of all directories of the state that were visited are added to visited.
+    # Every stack entry is (dirpath, include, exclude, max_depth), where the filters and the remaining depth are the
+    # ones inherited from the parent directory.
+    stack = [(root, None, None, None)]  # type: list[tuple[str, list[str] | None, list[str] | None, int | None]]
+    while stack:
+        dirpath, include, exclude, max_depth = stack.pop()
+        directory = directories.get(dirpath)
+        if directory is not None:
+            include = directory.get('include')
+            exclude = directory.get('exclude')
+            max_depth = directory.get('max_depth')
+            if dirpath in unchanged_dirs:
+                visited.add(dirpath)
+                continue
+        list_start = time.time()
+        try:
+            dirstat = os.lstat(dirpath)
+            dirnames, dirfiles, subdirs = scan_directory(dirpath, include=include, exclude=exclude)
+        except OSError:
+            # Directories of the state which cannot be listed are checked on their own later
+            continue
+        if stats is not None:
+            stats.add_time('walk', time.time() - list_start)
+            stats.visit(files=len(dirfiles), directories=1)
+            stats.count('lstat', 1 + len(dirfiles))
+            stats.count('scandir')
+        filenames = [name for name, dummy in dirfiles]
+        if directory is None:
+            added_dirs.add(dirpath)
+            added_dirs.update(os.path.join(dirpath, name) for name in dirnames)
+            added_files.update(os.path.join(dirpath, name) for name in filenames)
+            if filenames:
+                global_differences.append(diff_listing(dirpath, 'files', set(), set(filenames)))
+            if dirnames:
+                global_differences.append(diff_listing(dirpath, 'dirs', set(), set(dirnames)))
+            ex_dirs = set()  # type: set[str]
+        else:
+            visited.add(dirpath)
+            check_directory(
+                dirpath, directory, global_differences, added_files, added_dirs, removed_dirs, changed_dirs,
+                stats=stats, listing=(dirstat, dirnames, filenames))
+            if 'directories' not in directory:
+                continue
+            ex_dirs = set(directory['directories'])
+        descend_added = max_depth is None or max_depth > 0
+        for name in reversed(dirnames):
+            subdir = os.path.join(dirpath, name)
+            if subdir in directories or (descend_added and name in subdirs and name not in ex_dirs):
+                stack.append((subdir, include, exclude, None if max_depth is None else max_depth - 1))
+
+
+def find_unchanged_directories(state, stats=None):
+    # type: (dict[str, t.Any], Stats | None) -> set[str]
+    # Recompute the tree digests of all directories from their current listings and attributes, using the recorded
+    # checksums and contents of the files. A directory whose tree digest did not change has no changes in its subtree
+    # under the assumption that the content of files whose attributes did not change also did not change.
+    directories = state['directories']  # type: dict[str, dict[str, t.Any]]
+    current = {}  # type: dict[str, str]
+    for path in iter_directories_bottom_up(directories):
+        directory = directories[path]
+        if 'tree_digest' not in directory:
+            continue
+        try:
+            dirstat = os.lstat(path)
+            dirnames, dirfiles, dummy = scan_directory(path, include=directory.get('include'), exclude=directory.get('exclude'))
+            files = []
+            for name, stat in dirfiles:
+                file_path = os.path.join(path, name)
+                file = dict(state['files'].get(file_path) or {})
+                file['stat'] = extract_stat(stat)
+                file.pop('symlink', None)
+                if is_symlink(stat):
+                    file['symlink'] = os.readlink(file_path)
+                files.append((name, file))
+        except OSError:
+            continue
+        if stats is not None:
+            stats.visit(directories=1)
+            stats.count('lstat', 1 + len(dirfiles))
+            stats.count('scandir')
+            stats.count('readlink', sum(1 for dummy, file in files if 'symlink' in file))
+        subdirs = None  # type: list[tuple[str, str | None]] | None
+        if 'directories' in directory:
+            subdirs = [(name, current.get(os.path.join(path, name))) for name in dirnames]
+        current[path] = tree_digest(extract_stat(dirstat), files, subdirs)
+    return set(path for path, digest in current.items() if digest == directories[path]['tree_digest'])
+
+
+def find_first_difference(
+    module,  # type: AnsibleModule
+    digester,  # type: FileDigester
+    state,  # type: dict[str, t.Any]
+    unchanged_dirs,  # type: set[str]
+    unchanged_files,  # type: set[str]
+    trust_stat=False,  # type: bool
+):
+    # type: (...) -> str | None
+    # Check the state cheapest first and return the path of the first file or directory that changed, or None if nothing
+    # changed: first the attributes and listings of the directories, then the attributes of the files, and finally the
+    # contents of the files. If trust_stat is true, the contents are not read at all, since no attribute changed.
+    directories = state['directories']  # type: dict[str, dict[str, t.Any]]
+    for path, directory in sorted(directories.items()):
+        if path in unchanged_dirs:
+            continue
+        dir_result = ([], set(), set(), set(), set())  # type: tuple[list[str], set[str], set[str], set[str], set[str]]
+        check_directory(path, directory, *dir_result, stats=digester.stats, quick=True)
+        if any(dir_result):
+            return path
+
+    all_files = state['files']  # type: dict[str, dict[str, t.Any]]
+    files = [(path, file) for path, file in sorted(all_files.items()) if path not in unchanged_files]
+    for check_content in ([False] if trust_stat else [False, True]):
+        for path, file in files:
+            file_result = ([], set(), set(), set(), set())  # type: tuple[list[str], set[str], set[str], set[str], set[str]]
+            check_file(
+                module, digester, path, file, *file_result,
+                trust_stat=trust_stat, contents=state.get('contents'), check_content=check_content, quick=True)
+            if any(file_result):
+                return path
+    return None
 
 
 def main():
@@ -236,19 +734,46 @@ def main():
     argument_spec = dict(
         state=dict(required=True, type='dict'),
         fail_on_diffs=dict(type='bool', default=False),
+        trust_stat=dict(type='bool', default=False),
+        workers=dict(type='int', default=1),
+        collect_stats=dict(type='bool', default=False),
+        stats_slowest_files=dict(type='int', default=10),
+        digest_cache=dict(type='path'),
+        digest_cache_size=dict(type='int', default=100000),
+        quick_check=dict(type='bool', default=False),
+        tree_diff=dict(type='bool', default=False),
     )
     module = AnsibleModule(
         argument_spec=argument_spec,
         supports_check_mode=True,
     )
 
-    state = module.params['state']
-    if not is_state(state):
-        if 'state' in state and is_state(state['state']):
-            # The whole result of the previous task was passed in
-            state = state['state']
-        else:
-            module.fail_json(msg='The value of the state parameter must be the result of community.internal_test_tools.files_collect')
+    state = load_state(module, module.params['state'], 'state')
+    if 'resume' in state:
+        module.fail_json(msg='The state is incomplete; use the resume_from option of community.internal_test_tools.files_collect to complete it')
+
+    if module.params['workers'] < 1:
+        module.fail_json(msg='workers must be at least 1')
+
+    if module.params['digest_cache_size'] < 1:
+        module.fail_json(msg='digest_cache_size must be at least 1')
+
+    algorithm = state.get('digest_algorithm', DEFAULT_DIGEST_ALGORITHM)
+    try:
+        create_digest(algorithm)
+    except ValueError:
+        module.fail_json(msg='The digest algorithm {0} used by the state is not supported by the Python interpreter on the managed node'.format(algorithm))
+
+    cache = None
+    if module.params['digest_cache'] is not None:
+        cache = DigestCache(module.params['digest_cache'], module.params['digest_cache_size'], algorithm=algorithm)
+    stats = None
+    if module.params['collect_stats']:
+        if module.params['stats_slowest_files'] < 0:
+            module.fail_json(msg='stats_slowest_files must not be negative')
+        stats = Stats(slowest_files=module.params['stats_slowest_files'])
+
+    digester = FileDigester(module, cache=cache, algorithm=algorithm, stats=stats)
 
     differences = []  # type: list[str]
     added_files = set()  # type: set[str]
@@ -259,75 +784,95 @@ def main():
     removed_dirs = set()  # type: set[str]
     changed_dirs = set()  # type: set[str]
 
-    for path, file in sorted(state['files'].items()):
-        check_file(module, path, file, differences, changed_files, changed_files_content, added_files, removed_files)
-
-    for path, directory in sorted(state['directories'].items()):
-        if not os.path.isdir(path):
-            removed_dirs.add(path)
-            continue
-        changed = False
-        if 'stat' in directory:
-            differences_neg = []  # type: list[str]
-            differences_pos = []  # type: list[str]
-            compare_stat(directory['stat'], path, differences_neg, differences_pos)
-            if differences_neg or differences_pos:
-                changed = True
-                differences.append('--- {path}\n+++ {path}\n{diffs}'.format(
-                    path=path,
-                    diffs='\n'.join(differences_neg + differences_pos),
-                ))
-        for dummy, dirnames, filenames in os.walk(path):
-            if 'files' in directory:
-                ex_files = sorted(directory['files'])
-                files = sorted(filenames)
-                if ex_files != files:
-                    changed = True
-                    for file in files:
-                        if file not in ex_files:
-                            added_files.add(os.path.join(path, file))
-                    modified = '{path} (files)'.format(path=path)
-                    differences.append(
-                        '\n'.join([
-                            line.rstrip('\n') for line in difflib.unified_diff(ex_files, files, modified, modified, n=3)]))
-            if 'directories' in directory:
-                ex_dirs = sorted(directory['directories'])
-                dirs = sorted(dirnames)
-                if ex_dirs != dirs:
-                    changed = True
-                    for dir in ex_dirs:
-                        if dir not in dirs:
-                            removed_dirs.add(os.path.join(path, dir))
-                    for dir in dirs:
-                        if dir not in ex_dirs:
-                            added_dirs.add(os.path.join(path, dir))
-                    modified = '{path} (dirs)'.format(path=path)
-                    differences.append(
-                        '\n'.join([
-                            line.rstrip('\n') for line in difflib.unified_diff(ex_dirs, dirs, modified, modified, n=3)]))
-            # No recursion
-            break
-        if changed:
-            changed_dirs.add(path)
-
-    result = dict(
-        changed=any([
-            len(added_files) > 0, len(removed_files) > 0, len(changed_files) > 0,
-            len(added_dirs) > 0, len(removed_dirs) > 0, len(changed_dirs) > 0,
-            len(differences) > 0,
-        ]),
-        changed_content=len(changed_files_content) > 0,
-        added_files=sorted(added_files),
-        removed_files=sorted(removed_files),
-        changed_files=sorted(changed_files),
-        changed_files_content=sorted(changed_files_content),
-        added_dirs=sorted(added_dirs),
-        removed_dirs=sorted(removed_dirs),
-        changed_dirs=sorted(changed_dirs),
-        diff=dict(
-            prepared='\n\n'.join(differences),
-        ),
-    )
+    unchanged_dirs = set()  # type: set[str]
+    unchanged_files = set()  # type: set[str]
+    if module.params['trust_stat']:
+        if stats is not None:
+            with stats.timer('walk'):
+                unchanged_dirs = find_unchanged_directories(state, stats=stats)
+        else:
+            unchanged_dirs = find_unchanged_directories(state)
+        for path in unchanged_dirs:
+            unchanged_files.update(os.path.join(path, name) for name in state['directories'][path]['files'])
+
+    # The time spent comparing is the time spent in the following loops without the time spent walking and hashing
+    compare_start = time.time()
+    if stats is not None:
+        compare_start -= stats.times['walk'] + stats.times['hash']
+
+    if module.params['quick_check']:
+        try:
+            first_difference = find_first_difference(
+                module, digester, state, unchanged_dirs, unchanged_files, trust_stat=module.params['trust_stat'])
+        except CheckError as exc:
+            module.fail_json(msg=str(exc))
+    else:
+        try:
+            check_files(
+                module,
+                digester,
+                [(path, file) for path, file in sorted(state['files'].items()) if path not in unchanged_files],
+                module.params['workers'],
+                differences,
+                changed_files,
+                changed_files_content,
+                added_files,
+                removed_files,
+                trust_stat=module.params['trust_stat'],
+                contents=state.get('contents'),
+            )
+        except CheckError as exc:
+            module.fail_json(msg=str(exc))
+
+        directories = state['directories']  # type: dict[str, dict[str, t.Any]]
+        visited = set()  # type: set[str]
+        if module.params['tree_diff']:
+            for root in find_tree_roots(directories):
+                check_tree(
+                    root, directories, unchanged_dirs, visited, differences, added_files, added_dirs, removed_dirs, changed_dirs,
+                    stats=stats)
+        # Without tree_diff, every directory is listed on its own. With tree_diff, this only checks the directories that
+        # were not visited by the walks, for example since they were removed.
+        for path, directory in sorted(directories.items()):
+            if path not in unchanged_dirs and path not in visited:
+                check_directory(path, directory, differences, added_files, added_dirs, removed_dirs, changed_dirs, stats=stats)
+
+    if stats is not None:
+        # With multiple workers, the hashing times of the threads are added up, so this is only an estimate
+        stats.add_time('diff', max(0.0, time.time() - compare_start - stats.times['walk'] - stats.times['hash']))
+
+    if cache is not None:
+        try:
+            cache.save()
+        except (IOError, OSError) as exc:
+            module.warn('Cannot write digest cache {path}: {exc}'.format(path=cache.path, exc=exc))
+
+    if module.params['quick_check']:
+        result = dict(
+            changed=first_difference is not None,
+            first_difference=first_difference,
+        )  # type: dict[str, t.Any]
+    else:
+        result = dict(
+            changed=any([
+                len(added_files) > 0, len(removed_files) > 0, len(changed_files) > 0,
+                len(added_dirs) > 0, len(removed_dirs) > 0, len(changed_dirs) > 0,
+                len(differences) > 0,
+            ]),
+            changed_content=len(changed_files_content) > 0,
+            added_files=sorted(added_files),
+            removed_files=sorted(removed_files),
+            changed_files=sorted(changed_files),
+            changed_files_content=sorted(changed_files_content),
+            added_dirs=sorted(added_dirs),
+            removed_dirs=sorted(removed_dirs),
+            changed_dirs=sorted(changed_dirs),
+            diff=dict(
+                prepared='\n\n'.join(differences),
+            ),
+        )
+    if stats is not None:
+        result['stats'] = stats.get_result()
     if result['changed'] and module.params['fail_on_diffs']:
         module.fail_json(msg='Found differences!', **result)  # type: ignore
     module.exit_json(**result)